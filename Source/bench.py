@@ -0,0 +1,259 @@
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import traceback
+
+import main
+
+# python bench.py [--sizes 10000,100000,1000000] [--output bench-results.json]
+#                 [--cache-pages N] [--readahead-pages N] [--seed N] [--wal] [--slotted] [--compress]
+# every workload runs in a forked child on a fresh file, so each starts with a cold cache
+# and reports its own peak memory
+
+DEFAULT_SIZES       = "10000,100000,1000000"
+DEFAULT_OUTPUT      = "bench-results.json"
+DEFAULT_SEED        = 42
+BENCH_FILENAME      = "bench.db"
+
+NUM_LOOKUPS         = 10000
+NUM_RANGE_SCANS     = 1000
+RANGE_SCAN_ROWS     = 100
+NUM_FULL_SCANS      = 3
+
+
+class BenchOptions:
+    def __init__(self):
+        self.sizes = [int(size) for size in DEFAULT_SIZES.split(",")]
+        self.output = DEFAULT_OUTPUT
+        self.max_cached_pages = main.DEFAULT_CACHE_PAGES
+        self.readahead_pages = main.DEFAULT_READAHEAD_PAGES
+        self.seed = DEFAULT_SEED
+        self.use_wal = False
+        self.leaf_format = main.LEAF_FORMAT_FIXED
+        self.compress = False
+
+
+def bench_row(id):
+    return main.Row(id, "user%d" % id, "person%d@example.com" % id)
+
+
+def open_fresh(options):
+    for filename in (BENCH_FILENAME, BENCH_FILENAME + main.WAL_SUFFIX):
+        if os.path.exists(filename):
+            os.remove(filename)
+    open(BENCH_FILENAME, "wb").close()
+    table = main.db_open(BENCH_FILENAME, False, options.max_cached_pages, options.use_wal,
+                         options.leaf_format, options.compress)
+    table.pager.readahead_pages = options.readahead_pages
+    return table
+
+
+def reopen(table, options):
+    main.db_close(table)
+    table = main.db_open(BENCH_FILENAME, False, options.max_cached_pages, options.use_wal)
+    table.pager.readahead_pages = options.readahead_pages
+    return table
+
+
+def load_sequential(options, num_rows):
+    # read workloads start from a bulk loaded file, reopened so the cache is cold
+    table = open_fresh(options)
+    main.bulk_load(table, [(id, bench_row(id)) for id in range(1, num_rows + 1)],
+                   main.DEFAULT_IMPORT_FILL_FACTOR)
+    return reopen(table, options)
+
+
+def time_ops(ops):
+    # latency of every op in seconds
+    latencies = []
+    for op in ops:
+        start = time.time()
+        op()
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def insert_ops(table, ids):
+    for id in ids:
+        statement = main.Statement(main.STATEMENT_INSERT)
+        statement.row_to_insert = bench_row(id)
+        yield lambda statement=statement: main.execute_insert(statement, table)
+
+
+def lookup_ops(table, ids):
+    for id in ids:
+        yield lambda id=id: main.cursor_row(main.table_find(table, id))
+
+
+def range_scan_ops(table, key_mins):
+    for key_min in key_mins:
+        statement = main.Statement(main.STATEMENT_SELECT)
+        statement.key_min = key_min
+        statement.key_max = key_min + RANGE_SCAN_ROWS - 1
+        yield lambda statement=statement: list(main.select_leaf_rows(statement, table))
+
+
+def full_scan_ops(table):
+    for _ in range(NUM_FULL_SCANS):
+        yield lambda: list(main.cursor_leaf_rows(main.table_start(table)))
+
+
+def run_workload(name, options, num_rows):
+    rng = random.Random(options.seed)
+    ids = range(1, num_rows + 1)
+    if name.startswith("insert"):
+        table = open_fresh(options)
+        if name == "insert_random":
+            rng.shuffle(ids)
+        elif name == "insert_reverse":
+            ids.reverse()
+        ops = insert_ops(table, ids)
+        rows_per_op = 1
+    else:
+        table = load_sequential(options, num_rows)
+        if name == "lookup_point":
+            ops = lookup_ops(table, [rng.randint(1, num_rows) for _ in range(NUM_LOOKUPS)])
+            rows_per_op = 1
+        elif name == "scan_range":
+            last_start = max(num_rows - RANGE_SCAN_ROWS + 1, 1)
+            ops = range_scan_ops(table, [rng.randint(1, last_start) for _ in range(NUM_RANGE_SCANS)])
+            rows_per_op = min(RANGE_SCAN_ROWS, num_rows)
+        else:
+            ops = full_scan_ops(table)
+            rows_per_op = num_rows
+
+    pager = table.pager
+    cache_hits = pager.cache_hits
+    cache_misses = pager.cache_misses
+    pages_read = pager.pages_read
+    pages_read_ahead = pager.pages_read_ahead
+    pages_written = pager.pages_written
+    start = time.time()
+    latencies = time_ops(ops)
+    # everything the workload wrote reaches the file before it counts as done
+    main.pager_checkpoint(pager)
+    seconds = time.time() - start
+    result = workload_result(name, num_rows, latencies, rows_per_op, seconds)
+    result["cache_hits"] = pager.cache_hits - cache_hits
+    result["cache_misses"] = pager.cache_misses - cache_misses
+    result["pages_read"] = pager.pages_read - pages_read
+    result["pages_read_ahead"] = pager.pages_read_ahead - pages_read_ahead
+    result["pages_written"] = pager.pages_written - pages_written
+    result["wal_frames_written"] = pager.wal_frames_written
+    main.db_close(table)
+    result["file_size"] = os.path.getsize(BENCH_FILENAME)
+    # kilobytes on linux
+    result["peak_memory_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def workload_result(name, num_rows, latencies, rows_per_op, seconds):
+    latencies = sorted(latencies)
+    return {
+        "workload": name,
+        "rows": num_rows,
+        "ops": len(latencies),
+        "seconds": seconds,
+        "ops_per_sec": len(latencies) / seconds,
+        "rows_per_sec": len(latencies) * rows_per_op / seconds,
+        "latency_us": {
+            "p50": percentile(latencies, 0.50) * 1e6,
+            "p95": percentile(latencies, 0.95) * 1e6,
+            "p99": percentile(latencies, 0.99) * 1e6,
+            "max": latencies[-1] * 1e6,
+        },
+    }
+
+
+def run_in_child(name, options, num_rows):
+    # fork so the workload gets its own memory high-water mark
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            output = os.fdopen(write_fd, "wb")
+            output.write(json.dumps(run_workload(name, options, num_rows)))
+            output.close()
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 64 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        print "Workload %s failed." % name
+        exit(1)
+    return json.loads("".join(chunks))
+
+
+WORKLOADS = ("insert_sequential", "insert_random", "insert_reverse",
+             "lookup_point", "scan_range", "scan_full")
+
+
+def parse_options(argv):
+    options = BenchOptions()
+    if "--sizes" in argv:
+        options.sizes = [int(size) for size in argv[argv.index("--sizes") + 1].split(",")]
+    if "--output" in argv:
+        options.output = argv[argv.index("--output") + 1]
+    if "--cache-pages" in argv:
+        options.max_cached_pages = int(argv[argv.index("--cache-pages") + 1])
+    if "--readahead-pages" in argv:
+        options.readahead_pages = int(argv[argv.index("--readahead-pages") + 1])
+    if "--seed" in argv:
+        options.seed = int(argv[argv.index("--seed") + 1])
+    options.use_wal = "--wal" in argv
+    if "--slotted" in argv:
+        options.leaf_format = main.LEAF_FORMAT_SLOTTED
+    options.compress = "--compress" in argv
+    return options
+
+
+def bench(argv):
+    options = parse_options(argv)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "page_size": main.PAGE_SIZE,
+        "cache_pages": options.max_cached_pages,
+        "readahead_pages": options.readahead_pages,
+        "seed": options.seed,
+        "wal": options.use_wal,
+        "slotted": options.leaf_format == main.LEAF_FORMAT_SLOTTED,
+        "compress": options.compress,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": [],
+    }
+    for num_rows in options.sizes:
+        for name in WORKLOADS:
+            result = run_in_child(name, options, num_rows)
+            report["results"].append(result)
+            print "%-18s %8d rows  %10.0f ops/s  p50 %8.1f us  p99 %8.1f us" % (
+                name, num_rows, result["ops_per_sec"], result["latency_us"]["p50"],
+                result["latency_us"]["p99"])
+    os.remove(BENCH_FILENAME)
+    with open(options.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print "Results written to %s." % options.output
+
+
+if __name__ == "__main__":
+    bench(sys.argv)
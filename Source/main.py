@@ -1,6 +1,22 @@
+import bisect
+import collections
+import heapq
+import mmap
+import multiprocessing
 import os
+import re
+import signal
+import SocketServer
 import struct
-from sys import argv
+import threading
+import time
+import zlib
+from sys import argv, stdin, stdout
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class InputBuffer:
@@ -12,6 +28,7 @@ class InputBuffer:
 EXECUTE_SUCCESS         = 0
 EXECUTE_DUPLICATE_KEY   = 1
 EXECUTE_TABLE_FULL      = 2
+EXECUTE_INDEX_EXISTS    = 3
 
 # meta command result
 META_COMMAND_SUCCESS                = 0
@@ -24,9 +41,39 @@ PREPARE_UNRECOGNIZED_SUCCESS    = 2
 PREPARE_STRING_TOO_LONG         = 3
 PREPARE_NEGATIVE_ID             = 4
 
+# result output format
+OUTPUT_FORMAT_TEXT      = "text"
+OUTPUT_FORMAT_TSV       = "tsv"
+OUTPUT_FORMAT_BINARY    = "binary"  # id, then length-prefixed username and email
+OUTPUT_BUFFER_SIZE      = 64 * 1024
+NETWORK_BUFFER_SIZE     = 64 * 1024     # bytes read from a client at a time
+
 # statement type
 STATEMENT_INSERT    = 0
 STATEMENT_SELECT    = 1
+STATEMENT_CREATE_INDEX  = 2
+STATEMENT_DELETE    = 3
+STATEMENT_UPDATE    = 4
+STATEMENT_TYPE_NAMES = {
+    STATEMENT_INSERT: "insert",
+    STATEMENT_SELECT: "select",
+    STATEMENT_CREATE_INDEX: "create index",
+    STATEMENT_DELETE: "delete",
+    STATEMENT_UPDATE: "update",
+}
+
+# what a select can return instead of its rows, worked out from the tree without decoding rows
+AGGREGATE_COUNT         = "count(*)"
+AGGREGATE_MIN           = "min(id)"
+AGGREGATE_MAX           = "max(id)"
+AGGREGATES              = (AGGREGATE_COUNT, AGGREGATE_MIN, AGGREGATE_MAX)
+
+# statement latencies are counted in power-of-two microsecond buckets, the last one open-ended
+LATENCY_HISTOGRAM_BUCKETS = 25
+
+# statements slower than this many seconds go to the slow log, when there is one
+DEFAULT_SLOW_LOG_THRESHOLD  = 0.1
+TRACE_MAX_LISTED_PAGES      = 16
 
 COLUMN_USERNAME_SIZE    = 32
 COLUMN_EMAIL_SIZE       = 255
@@ -43,6 +90,19 @@ class Statement:
     def __init__(self, _type):
         self.type = _type
         self.row_to_insert = None
+        # set instead of row_to_insert by the multi-row form of insert
+        self.rows_to_insert = None
+        # inclusive id bounds of a select, None leaves that side open
+        self.key_min = None
+        self.key_max = None
+        # indexed column of a create index, or the column a select filters on
+        self.column = None
+        self.column_value = None
+        self.column_prefix = False
+        # new column values of an update, by column name
+        self.assignments = None
+        # one of AGGREGATES, the select returns it instead of the rows
+        self.aggregate = None
 
 
 # compact representation of a row
@@ -53,26 +113,136 @@ ID_OFFSET       = 0
 USERNAME_OFFSET = ID_OFFSET + ID_SIZE
 EMAIL_OFFSET    = USERNAME_OFFSET + USERNAME_SIZE
 ROW_SIZE        = ID_SIZE + USERNAME_SIZE + EMAIL_SIZE
-
-PAGE_SIZE       = 4096
-TABLE_MAX_PAGES = 100
-
-malloc_a_page_memory = lambda: "\x00" * PAGE_SIZE
-modify_memory = lambda page, buf, offset: page[:offset] + buf + page[(offset + len(buf)):]
+ROW_FORMAT      = "I%ds%ds" % (USERNAME_SIZE, EMAIL_SIZE)
+
+# precompiled layouts of single fields and rows
+UINT8       = struct.Struct("B")
+BOOL        = struct.Struct("?")
+UINT16      = struct.Struct("H")
+UINT32      = struct.Struct("I")
+ROW_STRUCT  = struct.Struct(ROW_FORMAT)
+
+PAGE_SIZE           = 4096
+DEFAULT_CACHE_PAGES = 100   # memory budget of the page cache, in pages
+# a scan that has moved along this many leaves reads the next ones ahead, at most
+# a quarter of the cache at a time
+READAHEAD_TRIGGER_LEAVES    = 2
+DEFAULT_READAHEAD_PAGES     = 32
+
+# scripts run with --script or --batch are read this many bytes at a time
+BATCH_READ_BUFFER_SIZE = 1 << 20
+
+# share of a page .import fills when it builds the tree bottom-up
+DEFAULT_IMPORT_FILL_FACTOR = 1.0
+
+# a checkpoint runs once this many pages are dirty or this many seconds have passed
+DEFAULT_CHECKPOINT_DIRTY_PAGES  = 64
+DEFAULT_CHECKPOINT_INTERVAL     = 30
+
+# write-ahead log, a frame is a header followed by a full page image
+WAL_SUFFIX                  = "-wal"
+WAL_FRAME_HEADER_FORMAT     = "III"     # page num, commit flag, crc32 of the page
+WAL_FRAME_HEADER            = struct.Struct(WAL_FRAME_HEADER_FORMAT)
+WAL_FRAME_HEADER_SIZE       = WAL_FRAME_HEADER.size
+WAL_COMMIT_MARKER           = 0xFFFFFFFF    # page num of a commit record without a page
+DEFAULT_WAL_COMMIT_WINDOW   = 0         # seconds commits may wait to share one fsync
+
+# compressed storage, the file starts with a header and pages are zlib images of
+# varying size, a page-location map written at checkpoints says where each one is
+COMPRESSED_FILE_MAGIC       = "MSDBZLIB"
+COMPRESSED_FILE_HEADER      = struct.Struct("=8sQIII")  # magic, map offset, map size, map capacity, num pages
+COMPRESSED_PAGE_LOCATION    = struct.Struct("=QII")     # offset, size, capacity of a page image
+COMPRESSED_EXTENT_ALIGNMENT = 256   # slack so a page that grows a little is rewritten in place
+COMPRESSION_LEVEL           = 6
+
+# pages are mutable buffers, fields are read and written in place
+malloc_a_page_memory = lambda: bytearray(PAGE_SIZE)
 
 
 class Pager:
-    def __init__(self, file_descriptor, file_length, num_pages):
+    def __init__(self, file_descriptor, file_length, num_pages, use_mmap=False,
+                 max_cached_pages=DEFAULT_CACHE_PAGES):
         self.file_descriptor = file_descriptor
         self.file_length = file_length
         self.num_pages = num_pages
-        self.pages = ["" for _ in range(TABLE_MAX_PAGES)]
+        # in mmap mode each cached page is a shared mapping of the file itself
+        self.use_mmap = use_mmap
+        # page cache, least recently used page first
+        self.pages = collections.OrderedDict()
+        self.max_cached_pages = max_cached_pages
+        # pinned pages are held by an operation and must not be evicted
+        self.pin_counts = {}
+        # pages modified since they were last written back
+        self.dirty_pages = set()
+        self.checkpoint_dirty_pages = DEFAULT_CHECKPOINT_DIRTY_PAGES
+        self.checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        self.last_checkpoint_time = time.time()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.pages_read = 0     # from the file or the log, new pages aren't read
+        self.pages_read_ahead = 0
+        self.pages_written = 0
+        # mapped pages are read ahead by the os
+        self.readahead_pages = 0 if use_mmap else DEFAULT_READAHEAD_PAGES
+        self.leaf_splits = 0
+        self.internal_splits = 0
+        self.root_splits = 0
+        # statement type -> latency histogram, see record_statement_latency
+        self.statement_latencies = {}
+        # statement tracing, traced_pages collects the pages get_page hands out while it is on
+        self.tracing = False
+        self.traced_pages = None
+        self.slow_log = None        # file statements slower than the threshold are logged to
+        self.slow_log_threshold = DEFAULT_SLOW_LOG_THRESHOLD
+        self.slow_log_latch = None
+        self.num_checkpoints = 0
+        # a batch run commits once, at the checkpoint it ends with
+        self.batch = False
+        # write-ahead log, None unless the database was opened in wal mode
+        self.wal_file = None
+        self.wal_index = {}     # page num -> offset of its latest frame in the log
+        self.wal_uncommitted_frames = 0
+        self.wal_commit_window = DEFAULT_WAL_COMMIT_WINDOW
+        self.wal_last_sync_time = time.time()
+        self.wal_commits = 0            # commits appended to the log so far
+        self.wal_synced_commits = 0     # of those, the ones an fsync made durable
+        self.wal_sync_latch = None      # held by the committer syncing the log for the others
+        self.wal_frames_written = 0
+        self.wal_syncs = 0
+        # catalog of indexes and free pages, 0 until the database needs one
+        self.catalog_page_num = 0
+        # compressed storage, None unless the database was created compressed
+        self.page_locations = None  # page num -> [offset, size, capacity] of its image
+        self.map_location = [0, 0, 0]
+        # unused extents as [offset, capacity], those freed since the last map write
+        # are still referenced by the map on disk and wait until it is replaced
+        self.free_extents = []
+        self.pending_free_extents = []
+        self.unmapped_page_writes = 0   # page images written since the map was
+        # latches, None unless the pager is shared between threads by connect()
+        self.cache_latch = None     # the cached pages and their lru order
+        self.file_latch = None      # file positions of the database and the log
+        self.page_latches = {}      # page num -> latch held while the page is read in
+        # multiversion reads, snapshots is None unless the pager was shared with mvcc on
+        self.snapshots = None           # committed version -> number of readers reading it
+        self.committed_version = 0
+        self.write_version = None       # version the running write statement commits as
+        self.copied_pages = set()       # pages the running write statement has its own copies of
+        self.shadow_pages = {}          # page num -> [(version, the page as it was before it)]
+        self.thread_state = None        # .snapshot of a reading thread, .writing of the writer
 
 
 class Table:
-    def __init__(self, pager, root_page_num):
+    def __init__(self, pager, root_page_num, layout):
         self.pager = pager
         self.root_page_num = root_page_num
+        self.layout = layout
+        # secondary indexes by column name, each one a tree of its own
+        self.indexes = {}
+        # None unless the table is partitioned, then the table of every partition, the first
+        # one's tree is this table's own
+        self.partitions = None
+        self.partition_pool = None  # worker processes a scan over the partitions fans out to
 
 
 class Cursor:
@@ -83,11 +253,137 @@ class Cursor:
         self.end_of_table = end_of_table
 
 
-def print_row(row):
-    id = row.id
-    username = row.username.replace("\x00", "")
-    email = row.email.replace("\x00", "")
-    print "(%d, %s, %s)" % (id, username, email)
+class ResultWriter:
+    def __init__(self, stream, format):
+        self.stream = stream
+        self.format = format
+        # formatted rows waiting to be written in one go
+        self.chunks = []
+        self.buffered_size = 0
+
+
+def format_row(row, format):
+    username = row.username.rstrip("\x00")
+    email = row.email.rstrip("\x00")
+    if format == OUTPUT_FORMAT_TSV:
+        return "%d\t%s\t%s\n" % (row.id, username, email)
+    elif format == OUTPUT_FORMAT_BINARY:
+        return struct.pack("IB", row.id, len(username)) + username + struct.pack("H", len(email)) + email
+    return "(%d, %s, %s)\n" % (row.id, username, email)
+
+
+def format_value(value, format):
+    # a single value, None when an aggregate has no rows to go by
+    if format == OUTPUT_FORMAT_TSV:
+        if value is None:
+            return "NULL\n"
+        return "%d\n" % value
+    elif format == OUTPUT_FORMAT_BINARY:
+        return struct.pack("BI", value is not None, value or 0)
+    if value is None:
+        return "(NULL)\n"
+    return "(%d)\n" % value
+
+
+def writer_write_value(writer, value):
+    chunk = format_value(value, writer.format)
+    writer.chunks.append(chunk)
+    writer.buffered_size += len(chunk)
+
+
+def writer_write_rows(writer, rows):
+    format = writer.format
+    chunk = "".join([format_row(row, format) for row in rows])
+    writer.chunks.append(chunk)
+    writer.buffered_size += len(chunk)
+    if writer.buffered_size >= OUTPUT_BUFFER_SIZE:
+        writer_flush(writer)
+
+
+def writer_flush(writer):
+    writer.stream.write("".join(writer.chunks))
+    writer.chunks = []
+    writer.buffered_size = 0
+
+
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.num_readers = 0
+        self.writing = False
+        # once a writer waits new readers queue behind it, a stream of selects can't starve it
+        self.num_waiting_writers = 0
+
+
+def read_lock_acquire(lock):
+    with lock.condition:
+        while lock.writing or lock.num_waiting_writers:
+            lock.condition.wait()
+        lock.num_readers += 1
+
+
+def read_lock_release(lock):
+    with lock.condition:
+        lock.num_readers -= 1
+        if lock.num_readers == 0:
+            lock.condition.notify_all()
+
+
+def write_lock_acquire(lock):
+    with lock.condition:
+        lock.num_waiting_writers += 1
+        while lock.writing or lock.num_readers:
+            lock.condition.wait()
+        lock.num_waiting_writers -= 1
+        lock.writing = True
+
+
+def write_lock_release(lock):
+    with lock.condition:
+        lock.writing = False
+        lock.condition.notify_all()
+
+
+class StatementTrace:
+    # what one statement cost, counters are taken before it runs and turned into deltas after
+    def __init__(self, pager):
+        self.start = time.time()
+        self.seconds = 0.0
+        self.page_accesses = pager.cache_hits + pager.cache_misses
+        self.cache_misses = pager.cache_misses
+        self.pages_read = pager.pages_read
+        self.leaf_splits = pager.leaf_splits
+        self.internal_splits = pager.internal_splits
+        self.root_splits = pager.root_splits
+        # distinct pages touched, only known while tracing is on
+        self.pages = None
+
+
+class Database:
+    # one per open file, shared by all the connections to it
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.lock = ReadWriteLock()
+        self.num_connections = 0
+        # with mvcc on, the indexes as of the last commit, what snapshots get to use
+        self.committed_indexes = dict(table.indexes)
+
+
+class Connection:
+    # used by one thread at a time, the database behind it is shared
+    def __init__(self, database):
+        self.database = database
+        # where execute writes the rows of a select, as in the repl
+        self.writer = ResultWriter(stdout, OUTPUT_FORMAT_TEXT)
+        # with tracing on, execute leaves the trace of each statement here
+        self.tracing = False
+        self.last_trace = None
+
+
+# open databases by real path, so connections to one file share its pager
+open_databases = {}
+open_databases_lock = threading.Lock()
 
 
 # node type
@@ -115,7 +411,8 @@ INTERNAL_NODE_HEADER_SIZE       = COMMON_NODE_HEADER_SIZE + INTERNAL_NODE_NUM_KE
 INTERNAL_NODE_KEY_SIZE      = struct.calcsize("I")
 INTERNAL_NODE_CHILD_SIZE    = struct.calcsize("I")
 INTERNAL_NODE_CELL_SIZE     = INTERNAL_NODE_CHILD_SIZE + INTERNAL_NODE_KEY_SIZE
-INTERNAL_NODE_MAX_CELLS     = 3  # keep this small for testing
+INTERNAL_NODE_SPACE_FOR_CELLS   = PAGE_SIZE - INTERNAL_NODE_HEADER_SIZE
+INTERNAL_NODE_MAX_CELLS         = INTERNAL_NODE_SPACE_FOR_CELLS / INTERNAL_NODE_CELL_SIZE
 
 # leaf node header layout
 LEAF_NODE_NUM_CELLS_SIZE    = struct.calcsize("I")
@@ -136,51 +433,169 @@ LEAF_NODE_MAX_CELLS         = LEAF_NODE_SPACE_FOR_CELLS / LEAF_NODE_CELL_SIZE
 LEAF_NODE_RIGHT_SPLIT_COUNT = (LEAF_NODE_MAX_CELLS + 1) / 2
 LEAF_NODE_LEFT_SPLIT_COUNT  = (LEAF_NODE_MAX_CELLS + 1) - LEAF_NODE_RIGHT_SPLIT_COUNT
 
+# whole-leaf decoding, one cell format repeated once per cell, packed without alignment
+LEAF_NODE_CELL_FORMAT       = "I" + ROW_FORMAT
+LEAF_NODE_STRUCTS           = {}    # (cell format, num cells) -> struct.Struct
+if numpy is not None:
+    LEAF_NODE_CELL_DTYPE = numpy.dtype([("key", "=u4"), ("id", "=u4"),
+                                        ("username", "S%d" % USERNAME_SIZE),
+                                        ("email", "S%d" % EMAIL_SIZE)])
+
+
+# slotted leaf layout, a directory of (key, cell offset) slots grows up from the header
+# while the cells, a length-prefixed username and email, grow down from the end of the page
+SLOTTED_LEAF_NODE_CONTENT_START_SIZE    = struct.calcsize("H")
+SLOTTED_LEAF_NODE_CONTENT_START_OFFSET  = LEAF_NODE_HEADER_SIZE     # 0 stands for PAGE_SIZE
+SLOTTED_LEAF_NODE_FRAGMENTED_SIZE       = struct.calcsize("H")
+SLOTTED_LEAF_NODE_FRAGMENTED_OFFSET     = SLOTTED_LEAF_NODE_CONTENT_START_OFFSET + \
+                                            SLOTTED_LEAF_NODE_CONTENT_START_SIZE
+SLOTTED_LEAF_NODE_HEADER_SIZE           = LEAF_NODE_HEADER_SIZE + SLOTTED_LEAF_NODE_CONTENT_START_SIZE + \
+                                            SLOTTED_LEAF_NODE_FRAGMENTED_SIZE
+SLOTTED_LEAF_NODE_SLOT_FORMAT           = "IH"  # key, cell offset
+SLOTTED_LEAF_NODE_SLOT                  = struct.Struct("=" + SLOTTED_LEAF_NODE_SLOT_FORMAT)
+SLOTTED_LEAF_NODE_SPACE_FOR_CELLS       = PAGE_SIZE - SLOTTED_LEAF_NODE_HEADER_SIZE
+
+# leaf format of the table, chosen when the database is created
+LEAF_FORMAT_FIXED   = 0
+LEAF_FORMAT_SLOTTED = 1
+
+
+class TreeLayout:
+    # cell layout of one kind of b+tree, keys are packed with key_format and
+    # followed by value_size bytes of value in the leaves
+    # slotted leaves hold only the key and a cell offset in their cells, the row is elsewhere
+    def __init__(self, key_format, value_size, slotted=False):
+        self.key_struct = struct.Struct("=" + key_format)
+        self.key_size = self.key_struct.size
+        self.key_fields = len(self.key_struct.unpack("\x00" * self.key_size))
+        self.min_key = self.key_struct.unpack("\x00" * self.key_size)
+        if self.key_fields == 1:
+            self.min_key = self.min_key[0]
+        self.value_size = value_size
+        self.slotted = slotted
+        if slotted:
+            self.leaf_node_header_size = SLOTTED_LEAF_NODE_HEADER_SIZE
+            self.leaf_node_cell_size = SLOTTED_LEAF_NODE_SLOT.size
+            # rows with empty strings, two length bytes each
+            self.leaf_node_max_cells = SLOTTED_LEAF_NODE_SPACE_FOR_CELLS / (self.leaf_node_cell_size + 2)
+        else:
+            self.leaf_node_header_size = LEAF_NODE_HEADER_SIZE
+            self.leaf_node_cell_size = self.key_size + value_size
+            self.leaf_node_max_cells = LEAF_NODE_SPACE_FOR_CELLS / self.leaf_node_cell_size
+        self.leaf_node_right_split_count = (self.leaf_node_max_cells + 1) / 2
+        self.leaf_node_left_split_count = (self.leaf_node_max_cells + 1) - self.leaf_node_right_split_count
+        self.leaf_node_keys_cell_format = key_format + "%dx" % (self.leaf_node_cell_size - self.key_size)
+        self.internal_node_cell_size = INTERNAL_NODE_CHILD_SIZE + self.key_size
+        self.internal_node_max_cells = INTERNAL_NODE_SPACE_FOR_CELLS / self.internal_node_cell_size
+
+
+# the table keys rows by id, an index keys (column value, id) pairs and has no value
+TABLE_LAYOUT            = TreeLayout("I", ROW_SIZE)
+SLOTTED_TABLE_LAYOUT    = TreeLayout("I", ROW_SIZE, True)
+USERNAME_INDEX_LAYOUT   = TreeLayout("%dsI" % USERNAME_SIZE, 0)
+EMAIL_INDEX_LAYOUT      = TreeLayout("%dsI" % EMAIL_SIZE, 0)
+TREE_LAYOUTS            = (TABLE_LAYOUT, SLOTTED_TABLE_LAYOUT, USERNAME_INDEX_LAYOUT, EMAIL_INDEX_LAYOUT)
+
+# indexable columns
+INDEX_COLUMN_USERNAME   = 1
+INDEX_COLUMN_EMAIL      = 2
+INDEX_COLUMNS = {
+    "username": (INDEX_COLUMN_USERNAME, USERNAME_SIZE, USERNAME_INDEX_LAYOUT),
+    "email":    (INDEX_COLUMN_EMAIL, EMAIL_SIZE, EMAIL_INDEX_LAYOUT),
+}
+
+# catalog page, the table root has no parent so its parent pointer holds the
+# page number of the catalog, 0 while there is none
+CATALOG_NUM_INDEXES_OFFSET      = 0
+CATALOG_FIRST_FREE_PAGE_OFFSET  = CATALOG_NUM_INDEXES_OFFSET + struct.calcsize("I")
+CATALOG_NUM_FREE_PAGES_OFFSET   = CATALOG_FIRST_FREE_PAGE_OFFSET + struct.calcsize("I")
+CATALOG_LEAF_FORMAT_OFFSET      = CATALOG_NUM_FREE_PAGES_OFFSET + struct.calcsize("I")
+CATALOG_HEADER_SIZE             = CATALOG_LEAF_FORMAT_OFFSET + struct.calcsize("I")
+CATALOG_ENTRY                   = struct.Struct("II")  # index column, root page num
+# at the end of the page so catalogs from before partitioning read as one partition
+CATALOG_NUM_PARTITIONS_OFFSET   = PAGE_SIZE - struct.calcsize("I")
+
+# meta commands a partitioned table runs on each of its partitions in turn
+PARTITION_META_COMMANDS = (".btree", ".checkpoint", ".compression")
+
+# a partitioned table routes rows by id to one tree per file, the database file holds
+# partition 0 and the others sit next to it
+PARTITION_SUFFIX        = ".part%d"
+# merged rows of a partitioned select go to the writer this many at a time
+PARTITION_MERGE_BATCH   = 1024
+
+# a free page only holds the page number of the next free page, 0 ends the list
+FREE_PAGE_NEXT_OFFSET   = 0
+EMPTY_PAGE              = "\x00" * PAGE_SIZE
+
+# .vacuum rewrites the database next to it, then renames it over the original
+VACUUM_SUFFIX = "-vacuum"
+
 
 def get_node_type(node):
-    return struct.unpack("B", node[NODE_TYPE_OFFSET])[0]
+    return UINT8.unpack_from(node, NODE_TYPE_OFFSET)[0]
 
 
 def set_node_type(node, type):
-    buf = struct.pack("B", type)
-    return modify_memory(node, buf, NODE_TYPE_OFFSET)
+    UINT8.pack_into(node, NODE_TYPE_OFFSET, type)
 
 
 def is_node_root(node):
-    offset = IS_ROOT_OFFSET
-    string = node[offset: offset + IS_ROOT_SIZE]
-    return struct.unpack("?", string)[0]
+    return BOOL.unpack_from(node, IS_ROOT_OFFSET)[0]
 
 
 def set_node_root(node, is_root):
-    buf = struct.pack("?", is_root)
-    return modify_memory(node, buf, IS_ROOT_OFFSET)
+    BOOL.pack_into(node, IS_ROOT_OFFSET, is_root)
 
 
 def node_parent(node):
-    offset = PARENT_POINTER_OFFSET
-    string = node[offset: offset + PARENT_POINTER_SIZE]
-    return struct.unpack("I", string)[0]
+    return UINT32.unpack_from(node, PARENT_POINTER_OFFSET)[0]
+
+
+def set_node_parent(node, parent):
+    UINT32.pack_into(node, PARENT_POINTER_OFFSET, parent)
 
 
 def internal_node_num_keys(node):
-    offset = INTERNAL_NODE_NUM_KEYS_OFFSET
-    string = node[offset: offset + INTERNAL_NODE_NUM_KEYS_SIZE]
-    return struct.unpack("I", string)[0]
+    return UINT32.unpack_from(node, INTERNAL_NODE_NUM_KEYS_OFFSET)[0]
+
+
+def set_internal_node_num_keys(node, num_keys):
+    UINT32.pack_into(node, INTERNAL_NODE_NUM_KEYS_OFFSET, num_keys)
 
 
 def internal_node_right_child(node):
-    offset = INTERNAL_NODE_RIGHT_CHILD_OFFSET
-    string = node[offset: offset + INTERNAL_NODE_RIGHT_CHILD_SIZE]
-    return struct.unpack("I", string)[0]
+    return UINT32.unpack_from(node, INTERNAL_NODE_RIGHT_CHILD_OFFSET)[0]
+
+
+def set_internal_node_right_child(node, child):
+    UINT32.pack_into(node, INTERNAL_NODE_RIGHT_CHILD_OFFSET, child)
+
+
+def unpack_key(node, offset, layout):
+    key = layout.key_struct.unpack_from(node, offset)
+    if layout.key_fields == 1:
+        return key[0]
+    return key
 
 
-def internal_node_cell(node, cell_num):
-    offset = INTERNAL_NODE_HEADER_SIZE + cell_num * INTERNAL_NODE_CELL_SIZE
-    return node[offset: offset + INTERNAL_NODE_CELL_SIZE]
+def pack_key(node, offset, key, layout):
+    if layout.key_fields == 1:
+        layout.key_struct.pack_into(node, offset, key)
+    else:
+        layout.key_struct.pack_into(node, offset, *key)
+
+
+def internal_node_cell_offset(cell_num, layout):
+    return INTERNAL_NODE_HEADER_SIZE + cell_num * layout.internal_node_cell_size
 
 
-def internal_node_child(node, child_num):
+def internal_node_cell(node, cell_num, layout):
+    offset = internal_node_cell_offset(cell_num, layout)
+    return node[offset: offset + layout.internal_node_cell_size]
+
+
+def internal_node_child(node, child_num, layout):
     num_keys = internal_node_num_keys(node)
     if child_num > num_keys:
         print "Tried to access child_num %d > num_keys %d" % (child_num, num_keys)
@@ -188,51 +603,75 @@ def internal_node_child(node, child_num):
     elif child_num == num_keys:
         return internal_node_right_child(node)
     else:
-        offset = INTERNAL_NODE_HEADER_SIZE + child_num * INTERNAL_NODE_CELL_SIZE
-        string = node[offset: offset + INTERNAL_NODE_CHILD_SIZE]
-        return struct.unpack("I", string)[0]
+        return UINT32.unpack_from(node, internal_node_cell_offset(child_num, layout))[0]
+
+
+def set_internal_node_child(node, child_num, child, layout):
+    num_keys = internal_node_num_keys(node)
+    if child_num > num_keys:
+        print "Tried to access child_num %d > num_keys %d" % (child_num, num_keys)
+        exit(0)
+    elif child_num == num_keys:
+        set_internal_node_right_child(node, child)
+    else:
+        UINT32.pack_into(node, internal_node_cell_offset(child_num, layout), child)
 
 
-def internal_node_key(node, key_num):
-    offset = INTERNAL_NODE_HEADER_SIZE + key_num * INTERNAL_NODE_CELL_SIZE + INTERNAL_NODE_CHILD_SIZE
-    string = node[offset: offset + INTERNAL_NODE_KEY_SIZE]
-    return struct.unpack("I", string)[0]
+def internal_node_key(node, key_num, layout):
+    offset = internal_node_cell_offset(key_num, layout) + INTERNAL_NODE_CHILD_SIZE
+    return unpack_key(node, offset, layout)
+
+
+def set_internal_node_key(node, key_num, key, layout):
+    offset = internal_node_cell_offset(key_num, layout) + INTERNAL_NODE_CHILD_SIZE
+    pack_key(node, offset, key, layout)
 
 
 def leaf_node_num_cells(node):
-    offset = LEAF_NODE_NUM_CELLS_OFFSET
-    string = node[offset: offset + LEAF_NODE_NUM_CELLS_SIZE]
-    return struct.unpack("I", string)[0]
+    return UINT32.unpack_from(node, LEAF_NODE_NUM_CELLS_OFFSET)[0]
+
+
+def set_leaf_node_num_cells(node, num_cells):
+    UINT32.pack_into(node, LEAF_NODE_NUM_CELLS_OFFSET, num_cells)
 
 
 def leaf_node_next_leaf(node):
-    offset = LEAF_NODE_NEXT_LEAF_OFFSET
-    string = node[offset: offset + LEAF_NODE_NEXT_LEAF_SIZE]
-    return struct.unpack("I", string)[0]
+    return UINT32.unpack_from(node, LEAF_NODE_NEXT_LEAF_OFFSET)[0]
+
+
+def set_leaf_node_next_leaf(node, next_leaf):
+    UINT32.pack_into(node, LEAF_NODE_NEXT_LEAF_OFFSET, next_leaf)
 
 
-def leaf_node_cell(node, cell_num):
-    offset = LEAF_NODE_HEADER_SIZE + cell_num * LEAF_NODE_CELL_SIZE
-    return node[offset: offset + LEAF_NODE_CELL_SIZE]
+def leaf_node_cell_offset(cell_num, layout):
+    return layout.leaf_node_header_size + cell_num * layout.leaf_node_cell_size
 
 
-def leaf_node_key(node, cell_num):
-    offset = LEAF_NODE_HEADER_SIZE + cell_num * LEAF_NODE_CELL_SIZE
-    string = node[offset: offset + LEAF_NODE_KEY_SIZE]
-    return struct.unpack("I", string)[0]
+def leaf_node_cell(node, cell_num, layout):
+    offset = leaf_node_cell_offset(cell_num, layout)
+    return node[offset: offset + layout.leaf_node_cell_size]
+
+
+def leaf_node_key(node, cell_num, layout):
+    return unpack_key(node, leaf_node_cell_offset(cell_num, layout), layout)
+
+
+def set_leaf_node_key(node, cell_num, key, layout):
+    pack_key(node, leaf_node_cell_offset(cell_num, layout), key, layout)
 
 
 def leaf_node_value(node, cell_num):
-    offset = (LEAF_NODE_HEADER_SIZE + cell_num * LEAF_NODE_CELL_SIZE) + LEAF_NODE_KEY_SIZE
+    # rows only live in the leaves of the table
+    offset = leaf_node_cell_offset(cell_num, TABLE_LAYOUT) + LEAF_NODE_KEY_SIZE
     return node[offset: offset + LEAF_NODE_VALUE_SIZE]
 
 
-def get_node_max_key(node):
-    result = get_node_type(node)
-    if result == NODE_INTERNAL:
-        return internal_node_key(node, internal_node_num_keys(node) - 1)
-    elif result == NODE_LEAF:
-        return leaf_node_key(node, leaf_node_num_cells(node) - 1)
+def get_node_max_key(pager, node, layout):
+    # the largest key of an internal node lives in its rightmost subtree
+    if get_node_type(node) == NODE_LEAF:
+        return leaf_node_key(node, leaf_node_num_cells(node) - 1, layout)
+    right_child = get_page(pager, internal_node_right_child(node))
+    return get_node_max_key(pager, right_child, layout)
 
 
 def print_constants():
@@ -249,7 +688,7 @@ def indent(level):
         print " ",
 
 
-def print_tree(pager, page_num, indentation_level):
+def print_tree(pager, page_num, indentation_level, layout):
     node = get_page(pager, page_num)
     result = get_node_type(node)
 
@@ -259,106 +698,438 @@ def print_tree(pager, page_num, indentation_level):
         print "- leaf (size %d)" % num_keys
         for i in range(num_keys):
             indent(indentation_level + 1)
-            print "- %d" % leaf_node_key(node, i)
+            print "- %d" % leaf_node_key(node, i, layout)
     elif result == NODE_INTERNAL:
+        pin_page(pager, page_num)
         num_keys = internal_node_num_keys(node)
         indent(indentation_level)
         print "- internal (size %d)" % num_keys
         for i in range(num_keys):
-            child = internal_node_child(node, i)
-            print_tree(pager, child, indentation_level + 1)
+            child = internal_node_child(node, i, layout)
+            print_tree(pager, child, indentation_level + 1, layout)
 
             indent(indentation_level)
-            print "- key %d" % internal_node_key(node, i)
+            print "- key %d" % internal_node_key(node, i, layout)
         child = internal_node_right_child(node)
-        print_tree(pager, child, indentation_level + 1)
+        print_tree(pager, child, indentation_level + 1, layout)
+        unpin_page(pager, page_num)
 
 
-def serialize_row(src):
-    dest = struct.pack("I", src.id)
-    dest = dest + struct.pack("%ds" % USERNAME_SIZE, src.username)
-    dest = dest + struct.pack("%ds" % EMAIL_SIZE, src.email)
-    return dest
+def serialize_row(src, dest, offset):
+    ROW_STRUCT.pack_into(dest, offset, src.id, src.username, src.email)
 
 
 def deserialize_row(src):
-    id = struct.unpack("I", src[ID_OFFSET: ID_OFFSET + ID_SIZE])[0]
-    username = struct.unpack("%ds" % USERNAME_SIZE, src[USERNAME_OFFSET: USERNAME_OFFSET + USERNAME_SIZE])[0]
-    email = struct.unpack("%ds" % EMAIL_SIZE, src[EMAIL_OFFSET: EMAIL_OFFSET + EMAIL_SIZE])[0]
+    id, username, email = ROW_STRUCT.unpack_from(src)
     return Row(id, username, email)
 
 
+def leaf_node_struct(cell_format, num_cells):
+    layout = LEAF_NODE_STRUCTS.get((cell_format, num_cells))
+    if layout is None:
+        layout = struct.Struct("=" + cell_format * num_cells)
+        LEAF_NODE_STRUCTS[(cell_format, num_cells)] = layout
+    return layout
+
+
+def leaf_node_keys(node, layout):
+    # every key of a leaf in one unpack, composite keys come back as tuples
+    cells = leaf_node_struct(layout.leaf_node_keys_cell_format, leaf_node_num_cells(node))
+    keys = cells.unpack_from(node, layout.leaf_node_header_size)
+    if layout.key_fields == 1:
+        return keys
+    return zip(*[keys[i::layout.key_fields] for i in range(layout.key_fields)])
+
+
+def decode_leaf_node(node, layout):
+    # every cell of a leaf at once, as parallel sequences of keys, ids, usernames and emails
+    num_cells = leaf_node_num_cells(node)
+    if layout.slotted:
+        return decode_slotted_leaf_node(node, num_cells)
+    if numpy is not None:
+        cells = numpy.frombuffer(node, LEAF_NODE_CELL_DTYPE, num_cells, LEAF_NODE_HEADER_SIZE)
+        return (cells["key"].tolist(), cells["id"].tolist(),
+                cells["username"].tolist(), cells["email"].tolist())
+
+    values = leaf_node_struct(LEAF_NODE_CELL_FORMAT, num_cells).unpack_from(node, LEAF_NODE_HEADER_SIZE)
+    return values[0::4], values[1::4], values[2::4], values[3::4]
+
+
+def decode_slotted_leaf_node(node, num_cells):
+    slot_directory = leaf_node_struct(SLOTTED_LEAF_NODE_SLOT_FORMAT, num_cells)
+    slots = slot_directory.unpack_from(node, SLOTTED_LEAF_NODE_HEADER_SIZE)
+    keys = slots[0::2]
+    # slicing a str copy of the page yields strs whatever the page is
+    if isinstance(node, bytearray):
+        data = str(node)
+    else:
+        data = node[:]
+    usernames = []
+    emails = []
+    for offset in slots[1::2]:
+        username_end = offset + 1 + ord(data[offset])
+        usernames.append(data[offset + 1: username_end])
+        emails.append(data[username_end + 1: username_end + 1 + ord(data[username_end])])
+    return keys, keys, usernames, emails
+
+
+def slotted_leaf_node_content_start(node):
+    return UINT16.unpack_from(node, SLOTTED_LEAF_NODE_CONTENT_START_OFFSET)[0] or PAGE_SIZE
+
+
+def set_slotted_leaf_node_content_start(node, offset):
+    UINT16.pack_into(node, SLOTTED_LEAF_NODE_CONTENT_START_OFFSET, offset)
+
+
+def slotted_leaf_node_fragmented_bytes(node):
+    return UINT16.unpack_from(node, SLOTTED_LEAF_NODE_FRAGMENTED_OFFSET)[0]
+
+
+def set_slotted_leaf_node_fragmented_bytes(node, num_bytes):
+    UINT16.pack_into(node, SLOTTED_LEAF_NODE_FRAGMENTED_OFFSET, num_bytes)
+
+
+def slotted_leaf_node_cell_offset(node, cell_num, layout):
+    return UINT16.unpack_from(node, leaf_node_cell_offset(cell_num, layout) + layout.key_size)[0]
+
+
+def slotted_cell(row):
+    username = row.username.rstrip("\x00")
+    email = row.email.rstrip("\x00")
+    return chr(len(username)) + username + chr(len(email)) + email
+
+
+def slotted_cell_size(node, offset):
+    username_size = UINT8.unpack_from(node, offset)[0]
+    return 2 + username_size + UINT8.unpack_from(node, offset + 1 + username_size)[0]
+
+
+def slotted_leaf_node_row(node, cell_num, layout):
+    offset = slotted_leaf_node_cell_offset(node, cell_num, layout)
+    username_end = offset + 1 + UINT8.unpack_from(node, offset)[0]
+    email_end = username_end + 1 + UINT8.unpack_from(node, username_end)[0]
+    return Row(leaf_node_key(node, cell_num, layout), str(node[offset + 1: username_end]),
+               str(node[username_end + 1: email_end]))
+
+
+def slotted_leaf_node_free_bytes(node, layout):
+    # free space once the holes left by deleted cells are compacted
+    slots_end = leaf_node_cell_offset(leaf_node_num_cells(node), layout)
+    return slotted_leaf_node_content_start(node) - slots_end + slotted_leaf_node_fragmented_bytes(node)
+
+
+def leaf_entry_size(entry, layout):
+    if not layout.slotted:
+        return layout.leaf_node_cell_size
+    return layout.leaf_node_cell_size + len(slotted_cell(entry[1]))
+
+
+def leaf_node_has_room(node, value, layout):
+    if not layout.slotted:
+        return leaf_node_num_cells(node) < layout.leaf_node_max_cells
+    return slotted_leaf_node_free_bytes(node, layout) >= layout.leaf_node_cell_size + len(slotted_cell(value))
+
+
+def leaf_node_is_underfull(node, layout):
+    if not layout.slotted:
+        return leaf_node_num_cells(node) < layout.leaf_node_max_cells / 2
+    return slotted_leaf_node_free_bytes(node, layout) > SLOTTED_LEAF_NODE_SPACE_FOR_CELLS / 2
+
+
+def leaf_entries_fit(entries, layout):
+    # whether the entries fit in a single leaf
+    if not layout.slotted:
+        return len(entries) <= layout.leaf_node_max_cells
+    used = 0
+    for entry in entries:
+        used += leaf_entry_size(entry, layout)
+        if used > SLOTTED_LEAF_NODE_SPACE_FOR_CELLS:
+            return False
+    return True
+
+
+def leaf_entries_split_point(entries, layout):
+    # how many entries go left so both halves hold about the same number of bytes
+    sizes = [leaf_entry_size(entry, layout) for entry in entries]
+    total = sum(sizes)
+    best = 1
+    best_left = left = sizes[0]
+    for i in range(2, len(sizes)):
+        left += sizes[i - 1]
+        if abs(2 * left - total) < abs(2 * best_left - total):
+            best = i
+            best_left = left
+    return best
+
+
+def leaf_node_entries(node, layout):
+    # (key, row) of every cell of a table leaf
+    keys, ids, usernames, emails = decode_leaf_node(node, layout)
+    return [(keys[i], Row(ids[i], usernames[i], emails[i])) for i in range(len(keys))]
+
+
 def initialize_leaf_node(node):
-    # initialize node type
-    node = set_node_type(node, NODE_LEAF)
-    # initialize node root
-    node = set_node_root(node, False)
-    # initialize num cells
-    buf = struct.pack("I", 0)
-    node = modify_memory(node, buf, LEAF_NODE_NUM_CELLS_OFFSET)
-    # initialize next leaf
-    node = modify_memory(node, buf, LEAF_NODE_NEXT_LEAF_OFFSET) # 0 represents no sibling
-    return node
+    set_node_type(node, NODE_LEAF)
+    set_node_root(node, False)
+    set_leaf_node_num_cells(node, 0)
+    set_leaf_node_next_leaf(node, 0)  # 0 represents no sibling
 
 
 def initialize_internal_node(node):
-    # initialize node type
-    node = set_node_type(node, NODE_INTERNAL)
-    # initialize node root
-    node = set_node_root(node, False)
-    # initialize num keys
-    buf = struct.pack("I", 0)
-    node = modify_memory(node, buf, INTERNAL_NODE_NUM_KEYS_OFFSET)
-    return node
+    set_node_type(node, NODE_INTERNAL)
+    set_node_root(node, False)
+    set_internal_node_num_keys(node, 0)
 
 
 def leaf_node_find(table, page_num, key):
     node = get_page(table.pager, page_num)
-    num_cells = leaf_node_num_cells(node)
-
     cursor = Cursor(table, page_num, None, None)
 
-    # Binary search
-    min_index = 0
-    one_past_max_index = num_cells
-    while one_past_max_index != min_index:
-        index = (min_index + one_past_max_index) / 2
-        key_at_index = leaf_node_key(node, index)
-        if key == key_at_index:
-            cursor.cell_num = index
-            return cursor
-        if key < key_at_index:
-            one_past_max_index = index
-        else:
-            min_index = index + 1
-
-    cursor.cell_num = min_index
+    # Binary search over the decoded keys
+    cursor.cell_num = bisect.bisect_left(leaf_node_keys(node, table.layout), key)
     return cursor
 
 
-def get_page(pager, page_num):
-    if page_num > TABLE_MAX_PAGES:
-        print "Tried to fetch page number out of bounds. %d > %d" % (page_num, TABLE_MAX_PAGES)
-        exit(0)
+def map_page(pager, page_num):
+    # grow the file first, a page can only be mapped once it exists on disk
+    end_of_page = (page_num + 1) * PAGE_SIZE
+    if end_of_page > pager.file_length:
+        pager.file_descriptor.truncate(end_of_page)
+        pager.file_length = end_of_page
+    return mmap.mmap(pager.file_descriptor.fileno(), PAGE_SIZE, offset=page_num * PAGE_SIZE)
+
+
+def pin_page(pager, page_num):
+    pager.pin_counts[page_num] = pager.pin_counts.get(page_num, 0) + 1
+
+
+def unpin_page(pager, page_num):
+    pager.pin_counts[page_num] -= 1
+    if pager.pin_counts[page_num] == 0:
+        del pager.pin_counts[page_num]
+
+
+def mark_page_dirty(pager, page_num):
+    pager.dirty_pages.add(page_num)
+
+
+def pager_evict(pager):
+    # make room for one more page by dropping the least recently used unpinned page
+    if len(pager.pages) < pager.max_cached_pages:
+        return
 
-    if not pager.pages[page_num]:
-        page = malloc_a_page_memory()
-        num_pages = pager.file_length / PAGE_SIZE
-        if pager.file_length % PAGE_SIZE:
-            num_pages += 1
-        if page_num <= num_pages:
-            pager.file_descriptor.seek(page_num * PAGE_SIZE, os.SEEK_SET)
-            buf = pager.file_descriptor.read(PAGE_SIZE)
-            if buf:
-                page = buf
-        pager.pages[page_num] = page
+    for page_num in pager.pages:
+        if page_num not in pager.pin_counts:
+            break
+    else:
+        # everything cached is in use, go over budget rather than fail
+        return
+
+    if pager.use_mmap:
+        # unmapping keeps the changes in the os page cache, the next checkpoint syncs them,
+        # a shared pager leaves it to the last reader still holding the mapping
+        if pager.cache_latch is None:
+            pager.pages[page_num].close()
+        pager.dirty_pages.discard(page_num)
+    elif page_num in pager.dirty_pages:
+        pager_flush(pager, page_num)
+    del pager.pages[page_num]
+
+
+def pager_read_page(pager, page_num):
+    if pager.use_mmap:
+        if page_num * PAGE_SIZE < pager.file_length:
+            pager.pages_read += 1
+        return map_page(pager, page_num)
+
+    page = malloc_a_page_memory()
+    if pager.page_locations is not None:
+        location = pager.page_locations.get(page_num)
+        if location is not None:
+            pager.pages_read += 1
+            pager.file_descriptor.seek(location[0], os.SEEK_SET)
+            page[:] = zlib.decompress(pager.file_descriptor.read(location[1]))
+    elif page_num in pager.wal_index:
+        # newer than the database file until the next checkpoint
+        pager.pages_read += 1
+        pager.wal_file.seek(pager.wal_index[page_num] + WAL_FRAME_HEADER_SIZE, os.SEEK_SET)
+        page[:] = pager.wal_file.read(PAGE_SIZE)
+    elif page_num * PAGE_SIZE < pager.file_length:
+        pager.pages_read += 1
+        pager.file_descriptor.seek(page_num * PAGE_SIZE, os.SEEK_SET)
+        buf = pager.file_descriptor.read(PAGE_SIZE)
+        page[:len(buf)] = buf
+    return page
+
+
+def pager_prefetch(pager, page_nums):
+    # read the pages that aren't cached yet, those stored one after the other in a single read,
+    # pages in the log are left for get_page
+    extents = []
+    for page_num in page_nums:
+        if page_num in pager.pages or page_num in pager.wal_index:
+            continue
+        if pager.page_locations is not None:
+            location = pager.page_locations.get(page_num)
+            if location is not None:
+                extents.append((location[0], location[2], location[1], page_num))
+        elif (page_num + 1) * PAGE_SIZE <= pager.file_length:
+            extents.append((page_num * PAGE_SIZE, PAGE_SIZE, PAGE_SIZE, page_num))
+    extents.sort()
+
+    start = 0
+    while start < len(extents):
+        end = start + 1
+        while end < len(extents) and extents[end][0] == extents[end - 1][0] + extents[end - 1][1]:
+            end += 1
+        offset = extents[start][0]
+        pager.file_descriptor.seek(offset, os.SEEK_SET)
+        data = pager.file_descriptor.read(extents[end - 1][0] + extents[end - 1][2] - offset)
+        for extent_offset, _, size, page_num in extents[start:end]:
+            image = buffer(data, extent_offset - offset, size)
+            if pager.page_locations is not None:
+                image = zlib.decompress(image)
+            pager_evict(pager)
+            pager.pages[page_num] = bytearray(image)
+        pager.pages_read += end - start
+        pager.pages_read_ahead += end - start
+        start = end
+
+
+def get_page(pager, page_num):
+    if pager.traced_pages is not None:
+        pager.traced_pages.add(page_num)
+    if pager.snapshots is not None:
+        return get_page_versioned(pager, page_num)
+    if pager.cache_latch is not None:
+        return get_page_latched(pager, page_num)
+
+    page = pager.pages.pop(page_num, None)
+    if page is None:
+        # cache miss
+        pager.cache_misses += 1
+        pager_evict(pager)
+        page = pager_read_page(pager, page_num)
         if page_num >= pager.num_pages:
             pager.num_pages = page_num + 1
-
-    return pager.pages[page_num]
+    else:
+        pager.cache_hits += 1
+
+    # most recently used page goes to the back
+    pager.pages[page_num] = page
+    return page
+
+
+def get_page_latched(pager, page_num):
+    # the pager is shared between threads, a thread missing on a page holds that page's
+    # latch while it reads it so the others wait for the one read instead of repeating it
+    with pager.cache_latch:
+        page = pager.pages.pop(page_num, None)
+        if page is not None:
+            pager.pages[page_num] = page
+            pager.cache_hits += 1
+            return page
+        pager.cache_misses += 1
+        latch = pager.page_latches.setdefault(page_num, threading.Lock())
+
+    with latch:
+        with pager.cache_latch:
+            page = pager.pages.get(page_num)
+        if page is None:
+            with pager.file_latch:
+                page = pager_read_page(pager, page_num)
+            with pager.cache_latch:
+                with pager.file_latch:
+                    pager_evict(pager)
+                pager.pages[page_num] = page
+                if page_num >= pager.num_pages:
+                    pager.num_pages = page_num + 1
+        with pager.cache_latch:
+            pager.page_latches.pop(page_num, None)
+    return page
+
+
+def get_page_versioned(pager, page_num):
+    # readers see the page as of their snapshot, the writer works on a copy of its own so
+    # the page readers may hold never changes under them
+    snapshot = getattr(pager.thread_state, "snapshot", None)
+    if snapshot is not None:
+        while True:
+            page = get_page_latched(pager, page_num)
+            with pager.cache_latch:
+                shadow = snapshot_page(pager, page_num, snapshot)
+                if shadow is not None:
+                    return shadow
+                if pager.pages.get(page_num) is page:
+                    return page
+            # evicted meanwhile, go again
+
+    page = get_page_latched(pager, page_num)
+    if not getattr(pager.thread_state, "writing", False) or page_num in pager.copied_pages:
+        return page
+    with pager.cache_latch:
+        copy = bytearray(page)
+        # pinned until the commit, readers can't evict it half written
+        pager.pages[page_num] = copy
+        pin_page(pager, page_num)
+        pager.copied_pages.add(page_num)
+        pager.shadow_pages.setdefault(page_num, []).append((pager.write_version, page))
+    return copy
+
+
+def snapshot_page(pager, page_num, snapshot):
+    # the oldest version written after the snapshot kept the page as the snapshot saw it
+    for version, page in pager.shadow_pages.get(page_num, ()):
+        if version > snapshot:
+            return page
+    return None
+
+
+def snapshot_end(pager, snapshot):
+    with pager.cache_latch:
+        pager.snapshots[snapshot] -= 1
+        if pager.snapshots[snapshot] == 0:
+            del pager.snapshots[snapshot]
+            prune_shadow_pages(pager)
+
+
+def version_begin(pager):
+    with pager.cache_latch:
+        pager.write_version = pager.committed_version + 1
+    pager.thread_state.writing = True
+
+
+def version_commit(pager):
+    # publishing the version number is what makes the statement visible to new snapshots
+    pager.thread_state.writing = False
+    with pager.cache_latch:
+        pager.committed_version = pager.write_version
+        pager.write_version = None
+        for page_num in pager.copied_pages:
+            unpin_page(pager, page_num)
+        pager.copied_pages = set()
+        if not pager.snapshots:
+            # nobody reads an older version
+            pager.shadow_pages = {}
+
+
+def prune_shadow_pages(pager):
+    # an old page is kept while a snapshot from before the version that replaced it reads on,
+    # the caller holds the cache latch
+    oldest = pager.committed_version
+    if pager.write_version is not None:
+        oldest = pager.write_version - 1
+    if pager.snapshots:
+        oldest = min(oldest, min(pager.snapshots))
+    for page_num, versions in pager.shadow_pages.items():
+        versions = [(version, page) for version, page in versions if version > oldest]
+        if versions:
+            pager.shadow_pages[page_num] = versions
+        else:
+            del pager.shadow_pages[page_num]
 
 
-def internal_node_find_child(node, key):
+def internal_node_find_child(node, key, layout):
     # return the index of the child which should contain the given key
 
     num_keys = internal_node_num_keys(node)
@@ -367,7 +1138,7 @@ def internal_node_find_child(node, key):
     max_index = num_keys    # there is one more child than key
     while min_index != max_index:
         index = (min_index + max_index) / 2
-        key_to_right = internal_node_key(node, index)
+        key_to_right = internal_node_key(node, index, layout)
         if key_to_right >= key:
             max_index = index
         else:
@@ -378,8 +1149,8 @@ def internal_node_find_child(node, key):
 def internal_node_find(table, page_num, key):
     node = get_page(table.pager, page_num)
 
-    child_index = internal_node_find_child(node, key)
-    child_num = internal_node_child(node, child_index)
+    child_index = internal_node_find_child(node, key, table.layout)
+    child_num = internal_node_child(node, child_index, table.layout)
     child = get_page(table.pager, child_num)
     result = get_node_type(child)
     if result == NODE_LEAF:
@@ -400,22 +1171,133 @@ def table_find(table, key):
         return internal_node_find(table, root_page_num, key)
 
 
-def table_start(table):
-    cursor = table_find(table, 0)
+def table_seek(table, key):
+    # position a cursor on the first row whose key is >= key
+    cursor = table_find(table, key)
+    cursor.end_of_table = False
 
     node = get_page(table.pager, cursor.page_num)
-    num_cells = leaf_node_num_cells(node)
-    cursor.end_of_table = (num_cells == 0)
+    while cursor.cell_num >= leaf_node_num_cells(node):
+        # the key is past the end of this leaf, the next leaf starts after it
+        next_page_num = leaf_node_next_leaf(node)
+        if next_page_num == 0:
+            cursor.end_of_table = True
+            break
+        cursor.page_num = next_page_num
+        cursor.cell_num = 0
+        node = get_page(table.pager, next_page_num)
 
     return cursor
 
 
+def table_start(table):
+    return table_seek(table, table.layout.min_key)
+
+
 def cursor_value(cursor):
     page_num = cursor.page_num
     page = get_page(cursor.table.pager, page_num)
     return leaf_node_value(page, cursor.cell_num)
 
 
+def cursor_row(cursor):
+    if not cursor.table.layout.slotted:
+        return deserialize_row(cursor_value(cursor))
+    node = get_page(cursor.table.pager, cursor.page_num)
+    return slotted_leaf_node_row(node, cursor.cell_num, cursor.table.layout)
+
+
+def leaf_pages_after(table, key, key_max, count):
+    # up to count leaves following the one holding key, none past key_max, read off the
+    # internal nodes so none of those leaves is touched
+    pager = table.pager
+    layout = table.layout
+    path = []
+    node = get_page(pager, table.root_page_num)
+    while get_node_type(node) == NODE_INTERNAL:
+        child_index = internal_node_find_child(node, key, layout)
+        path.append((node, child_index))
+        node = get_page(pager, internal_node_child(node, child_index, layout))
+
+    # climb back up, taking the subtrees right of the path in order
+    page_nums = []
+    for depth in range(len(path) - 1, -1, -1):
+        node, child_index = path[depth]
+        if collect_leaf_pages(table, node, child_index + 1, len(path) - 1 - depth, key_max, count,
+                              page_nums):
+            break
+    return page_nums
+
+
+def collect_leaf_pages(table, node, first_child, levels_below, key_max, count, page_nums):
+    # the leaves under the children of node from first_child on, True once there are no more wanted
+    layout = table.layout
+    for child_index in range(first_child, internal_node_num_keys(node) + 1):
+        if key_max is not None and child_index > 0 and \
+                internal_node_key(node, child_index - 1, layout) >= key_max:
+            return True
+        child_num = internal_node_child(node, child_index, layout)
+        if levels_below == 0:
+            page_nums.append(child_num)
+        else:
+            child = get_page(table.pager, child_num)
+            if get_node_type(child) == NODE_LEAF:
+                page_nums.append(child_num)
+            elif collect_leaf_pages(table, child, 0, levels_below - 1, key_max, count, page_nums):
+                return True
+        if len(page_nums) >= count:
+            return True
+    return False
+
+
+def cursor_leaves(cursor, key_max=None):
+    # yield the leaf under the cursor and the ones after it up to the one holding key_max,
+    # once the walk has moved along a few leaves the ones after are read ahead
+    pager = cursor.table.pager
+    layout = cursor.table.layout
+    readahead = min(pager.readahead_pages, pager.max_cached_pages / 4)
+    leaves = 0
+    readahead_at = READAHEAD_TRIGGER_LEAVES
+    while not cursor.end_of_table:
+        node = get_page(pager, cursor.page_num)
+        num_cells = leaf_node_num_cells(node)
+        last_key = None
+        if num_cells:
+            last_key = leaf_node_key(node, num_cells - 1, layout)
+        next_page_num = leaf_node_next_leaf(node)
+        yield node
+
+        if (key_max is not None and last_key > key_max) or next_page_num == 0:
+            cursor.end_of_table = True
+            return
+        cursor.page_num = next_page_num
+        cursor.cell_num = 0
+        leaves += 1
+        if readahead and last_key is not None and leaves >= readahead_at:
+            page_nums = leaf_pages_after(cursor.table, last_key, key_max, readahead)
+            pager_prefetch(pager, page_nums)
+            if len(page_nums) < readahead:
+                # the rest of the walk is cached now
+                readahead = 0
+            readahead_at = leaves + readahead / 2
+
+
+def cursor_leaf_rows(cursor, key_max=None):
+    # yield the rows from the cursor on, a whole leaf is decoded before its rows are handed out
+    for node in cursor_leaves(cursor, key_max):
+        keys, ids, usernames, emails = decode_leaf_node(node, cursor.table.layout)
+        end = len(keys)
+        if key_max is not None and end and keys[-1] > key_max:
+            end = bisect.bisect_right(keys, key_max)
+        yield [Row(ids[i], usernames[i], emails[i]) for i in range(cursor.cell_num, end)]
+
+
+def cursor_rows(cursor, key_max=None):
+    for rows in cursor_leaf_rows(cursor, key_max):
+        for row in rows:
+            yield row
+
+
 def cursor_advance(cursor):
     page_num = cursor.page_num
     node = get_page(cursor.table.pager, page_num)
@@ -432,8 +1314,33 @@ def cursor_advance(cursor):
             cursor.cell_num = 0
 
 
-def pager_open(filename):
+def pager_open(filename, use_mmap=False, max_cached_pages=DEFAULT_CACHE_PAGES, use_wal=False,
+               compress=False):
+    if use_wal and use_mmap:
+        print "Write-ahead log is not supported in mmap mode."
+        exit(0)
+
     fd = open(filename, "rb+")
+    fd.seek(0, os.SEEK_END)
+    if fd.tell() == 0 and compress:
+        fd.write(COMPRESSED_FILE_HEADER.pack(COMPRESSED_FILE_MAGIC, 0, 0, 0, 0))
+    fd.seek(0, os.SEEK_SET)
+    if fd.read(len(COMPRESSED_FILE_MAGIC)) == COMPRESSED_FILE_MAGIC:
+        if use_wal or use_mmap:
+            print "Write-ahead log and mmap mode are not supported on a compressed database."
+            exit(0)
+        return compressed_pager_open(fd, max_cached_pages)
+
+    wal_filename = filename + WAL_SUFFIX
+    wal_file = None
+    if use_wal or os.path.exists(wal_filename):
+        wal_file = open(wal_filename, "a+b", 0)
+        wal_recover(fd, wal_file)
+        if not use_wal:
+            wal_file.close()
+            wal_file = None
+            os.remove(wal_filename)
+
     fd.seek(0, os.SEEK_END)
     file_length = fd.tell()
     if file_length % PAGE_SIZE != 0:
@@ -441,26 +1348,104 @@ def pager_open(filename):
         exit(0)
     num_pages = file_length / PAGE_SIZE
 
-    pager = Pager(fd, file_length, num_pages)
+    pager = Pager(fd, file_length, num_pages, use_mmap, max_cached_pages)
+    pager.wal_file = wal_file
     return pager
 
 
-def db_open(filename):
-    pager = pager_open(filename)
-    table = Table(pager, 0)
+def compressed_pager_open(fd, max_cached_pages):
+    fd.seek(0, os.SEEK_END)
+    file_length = fd.tell()
+    fd.seek(0, os.SEEK_SET)
+    _, map_offset, map_size, map_capacity, num_pages = COMPRESSED_FILE_HEADER.unpack(
+        fd.read(COMPRESSED_FILE_HEADER.size))
+
+    pager = Pager(fd, file_length, num_pages, False, max_cached_pages)
+    pager.page_locations = {}
+    pager.map_location = [map_offset, map_size, map_capacity]
+    if map_size:
+        fd.seek(map_offset, os.SEEK_SET)
+        page_map = zlib.decompress(fd.read(map_size))
+        entry_size = COMPRESSED_PAGE_LOCATION.size
+        for page_num in range(len(page_map) / entry_size):
+            location = COMPRESSED_PAGE_LOCATION.unpack_from(page_map, page_num * entry_size)
+            if location[1] != 0:
+                pager.page_locations[page_num] = list(location)
+
+    # whatever neither a page image nor the map covers is free
+    extents = [(location[0], location[2]) for location in pager.page_locations.values()]
+    extents.append((map_offset, map_capacity))
+    end = COMPRESSED_FILE_HEADER.size
+    for offset, capacity in sorted(extents):
+        if offset > end:
+            pager.free_extents.append([end, offset - end])
+        end = max(end, offset + capacity)
+    if file_length > end:
+        pager.free_extents.append([end, file_length - end])
+    # the last image may not fill its extent, new ones go after the slack
+    pager.file_length = max(file_length, end)
+    return pager
+
+
+def db_open(filename, use_mmap=False, max_cached_pages=DEFAULT_CACHE_PAGES, use_wal=False,
+            leaf_format=LEAF_FORMAT_FIXED, compress=False, num_partitions=1, partition_workers=None):
+    # the leaf format, compression and partitioning only matter for a new file, an existing
+    # one keeps its own
+    pager = pager_open(filename, use_mmap, max_cached_pages, use_wal, compress)
+    table = Table(pager, 0, TABLE_LAYOUT)
 
     if pager.num_pages == 0:
         # New database file. Initialize page 0 as leaf node.
         root_node = get_page(pager, 0)
-        root_node = initialize_leaf_node(root_node)
-        root_node = set_node_root(root_node, True)
-        table.pager.pages[0] = root_node
+        initialize_leaf_node(root_node)
+        set_node_root(root_node, True)
+        mark_page_dirty(pager, 0)
+        if leaf_format != LEAF_FORMAT_FIXED:
+            catalog = get_page(pager, get_catalog_page_num(pager))
+            UINT32.pack_into(catalog, CATALOG_LEAF_FORMAT_OFFSET, leaf_format)
+        if num_partitions > 1:
+            catalog = get_page(pager, get_catalog_page_num(pager))
+            UINT32.pack_into(catalog, CATALOG_NUM_PARTITIONS_OFFSET, num_partitions)
+    pager.catalog_page_num = node_parent(get_page(pager, 0))
+    num_partitions = 1
+    if pager.catalog_page_num != 0:
+        catalog = get_page(pager, pager.catalog_page_num)
+        if UINT32.unpack_from(catalog, CATALOG_LEAF_FORMAT_OFFSET)[0] == LEAF_FORMAT_SLOTTED:
+            table.layout = SLOTTED_TABLE_LAYOUT
+        num_partitions = max(UINT32.unpack_from(catalog, CATALOG_NUM_PARTITIONS_OFFSET)[0], 1)
+    load_indexes(table)
+
+    if num_partitions > 1:
+        partition = Table(pager, 0, table.layout)
+        partition.indexes = table.indexes
+        table.partitions = [partition]
+        for partition_num in range(1, num_partitions):
+            partition_filename = filename + PARTITION_SUFFIX % partition_num
+            open(partition_filename, "ab").close()
+            table.partitions.append(db_open(partition_filename, use_mmap, max_cached_pages, use_wal,
+                                            leaf_format, compress))
+        if partition_workers is None:
+            partition_workers = min(num_partitions, multiprocessing.cpu_count())
+        if partition_workers > 1:
+            # forked once, each scan tells the workers what changed since
+            table.partition_pool = multiprocessing.Pool(partition_workers, partition_worker_start, (table,))
 
     return table
 
 
+def table_pagers(table):
+    # every pager holding part of the table, a partitioned table has one per file
+    if table.partitions is None:
+        return [table.pager]
+    return [partition.pager for partition in table.partitions]
+
+
+def table_partition(table, id):
+    return table.partitions[id % len(table.partitions)]
+
+
 def print_prompt():
-    print "db >",
+    stdout.write("db > ")
 
 
 def read_input():
@@ -469,73 +1454,827 @@ def read_input():
 
 
 def pager_flush(pager, page_num):
-    if not pager.pages[page_num]:
+    if page_num not in pager.pages:
         print "Tried to flush null page"
         exit(0)
 
+    if pager.use_mmap:
+        # the mapping is the file, just ask the os to write it back
+        pager.pages[page_num].flush()
+        pager.pages_written += 1
+    elif pager.wal_file is not None:
+        # the database file only changes at checkpoints, park the page in the log
+        wal_append_frame(pager, page_num, pager.pages[page_num], False)
+        pager.wal_uncommitted_frames += 1
+    elif pager.page_locations is not None:
+        compressed_write_page(pager, page_num, pager.pages[page_num])
+    else:
+        pager_write_page(pager, page_num, pager.pages[page_num])
+    pager.dirty_pages.discard(page_num)
+
+
+def pager_write_page(pager, page_num, page):
     pager.file_descriptor.seek(page_num * PAGE_SIZE, os.SEEK_SET)
-    pager.file_descriptor.write(pager.pages[page_num])
+    pager.file_descriptor.write(page)
+    pager.file_length = max(pager.file_length, (page_num + 1) * PAGE_SIZE)
+    pager.pages_written += 1
+
+
+def compressed_allocate(pager, size):
+    # first fit among the unused extents, otherwise grow the file
+    alignment = COMPRESSED_EXTENT_ALIGNMENT
+    capacity = (size + alignment - 1) / alignment * alignment
+    for i, extent in enumerate(pager.free_extents):
+        if extent[1] >= size:
+            offset = extent[0]
+            capacity = min(capacity, extent[1])
+            extent[0] += capacity
+            extent[1] -= capacity
+            if extent[1] == 0:
+                del pager.free_extents[i]
+            return offset, capacity
+
+    offset = pager.file_length
+    pager.file_length += capacity
+    return offset, capacity
+
+
+def compressed_write_page(pager, page_num, page):
+    data = zlib.compress(buffer(page), COMPRESSION_LEVEL)
+    location = pager.page_locations.get(page_num)
+    # rewrite in place while the image still fits, otherwise move it
+    if location is None or len(data) > location[2]:
+        if location is not None:
+            pager.pending_free_extents.append([location[0], location[2]])
+        offset, capacity = compressed_allocate(pager, len(data))
+        location = [offset, 0, capacity]
+        pager.page_locations[page_num] = location
+    location[1] = len(data)
+
+    pager.file_descriptor.seek(location[0], os.SEEK_SET)
+    pager.file_descriptor.write(data)
+    pager.pages_written += 1
+    pager.unmapped_page_writes += 1
+
+
+def compressed_write_map(pager):
+    # the map goes to a fresh extent and the header, written last, switches over to it
+    page_map = bytearray(pager.num_pages * COMPRESSED_PAGE_LOCATION.size)
+    for page_num, location in pager.page_locations.items():
+        COMPRESSED_PAGE_LOCATION.pack_into(page_map, page_num * COMPRESSED_PAGE_LOCATION.size, *location)
+    data = zlib.compress(buffer(page_map), COMPRESSION_LEVEL)
+    offset, capacity = compressed_allocate(pager, len(data))
+    pager.file_descriptor.seek(offset, os.SEEK_SET)
+    pager.file_descriptor.write(data)
+    pager.file_descriptor.flush()
+    os.fsync(pager.file_descriptor.fileno())
+
+    pager.file_descriptor.seek(0, os.SEEK_SET)
+    pager.file_descriptor.write(COMPRESSED_FILE_HEADER.pack(COMPRESSED_FILE_MAGIC, offset, len(data),
+                                                            capacity, pager.num_pages))
+    pager.file_descriptor.flush()
+    os.fsync(pager.file_descriptor.fileno())
+
+    # nothing on disk refers to the old map and the old page images any more
+    if pager.map_location[2] != 0:
+        pager.free_extents.append([pager.map_location[0], pager.map_location[2]])
+    pager.free_extents.extend(pager.pending_free_extents)
+    pager.pending_free_extents = []
+    pager.map_location = [offset, len(data), capacity]
+    pager.unmapped_page_writes = 0
+
+
+def compression_stats(pager):
+    # pages stored, bytes they take on disk and how much smaller than plain pages that is
+    stored_bytes = sum(location[1] for location in pager.page_locations.values())
+    num_pages = len(pager.page_locations)
+    ratio = 0.0
+    if stored_bytes:
+        ratio = float(num_pages * PAGE_SIZE) / stored_bytes
+    return num_pages, stored_bytes, ratio
+
+
+def wal_append_frame(pager, page_num, page, commit):
+    pager.wal_file.seek(0, os.SEEK_END)
+    offset = pager.wal_file.tell()
+    checksum = zlib.crc32(buffer(page)) & 0xffffffff
+    pager.wal_file.write(WAL_FRAME_HEADER.pack(page_num, commit, checksum))
+    pager.wal_file.write(page)
+    pager.wal_index[page_num] = offset
+    pager.wal_frames_written += 1
+
+
+def wal_sync(pager):
+    # frames reach the log before their commit is counted, so the fsync covers that many
+    commits = pager.wal_commits
+    if commits == pager.wal_synced_commits:
+        return
+    os.fsync(pager.wal_file.fileno())
+    pager.wal_last_sync_time = time.time()
+    pager.wal_synced_commits = commits
+    pager.wal_syncs += 1
+
+
+def wal_wait_durable(pager, commit):
+    # group commit, the first committer to get here sleeps out what is left of the window
+    # while the ones after it queue up, then a single fsync covers all of their commits
+    if pager.wal_file is None or pager.wal_synced_commits >= commit:
+        return
+    with pager.wal_sync_latch:
+        if pager.wal_synced_commits >= commit:
+            return
+        delay = pager.wal_last_sync_time + pager.wal_commit_window - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with pager.file_latch:
+            wal_sync(pager)
+
+
+def wal_commit(pager):
+    # log every page the statement dirtied, the last frame carries the commit flag
+    if pager.wal_file is None or pager.batch:
+        return
+    wal_commit_latched(pager)
+
+
+def wal_commit_latched(pager):
+    if pager.file_latch is not None:
+        # snapshot readers of a shared pager may be reading frames meanwhile
+        with pager.file_latch:
+            wal_commit_frames(pager)
+        return
+    wal_commit_frames(pager)
+
+
+def wal_commit_frames(pager):
+    if not pager.dirty_pages and pager.wal_uncommitted_frames == 0:
+        return
+
+    dirty_pages = sorted(pager.dirty_pages)
+    for i in range(len(dirty_pages)):
+        page_num = dirty_pages[i]
+        wal_append_frame(pager, page_num, pager.pages[page_num], i == len(dirty_pages) - 1)
+    if not dirty_pages:
+        # everything was already spilled to the log, only the commit is missing
+        pager.wal_file.seek(0, os.SEEK_END)
+        pager.wal_file.write(WAL_FRAME_HEADER.pack(WAL_COMMIT_MARKER, True, 0))
+    pager.dirty_pages.clear()
+    pager.wal_uncommitted_frames = 0
+
+    # a commit is only acknowledged once synced, a shared pager's committers wait for it in
+    # wal_wait_durable after letting go of the database so that they can share one fsync,
+    # a lone committer has nobody to share with
+    pager.wal_commits += 1
+    if pager.file_latch is None or pager.wal_commit_window == 0:
+        wal_sync(pager)
+
+
+def wal_recover(fd, wal_file):
+    # copy every committed frame into the database file, a torn tail is dropped
+    wal_file.seek(0, os.SEEK_SET)
+    frames = []
+    while True:
+        header = wal_file.read(WAL_FRAME_HEADER_SIZE)
+        if len(header) < WAL_FRAME_HEADER_SIZE:
+            break
+        page_num, commit, checksum = WAL_FRAME_HEADER.unpack(header)
+        if page_num != WAL_COMMIT_MARKER:
+            page = wal_file.read(PAGE_SIZE)
+            if len(page) < PAGE_SIZE or zlib.crc32(page) & 0xffffffff != checksum:
+                break
+            frames.append((page_num, page))
+        if commit:
+            for frame_page_num, frame_page in frames:
+                fd.seek(frame_page_num * PAGE_SIZE, os.SEEK_SET)
+                fd.write(frame_page)
+            frames = []
+
+    fd.flush()
+    os.fsync(fd.fileno())
+    wal_file.truncate(0)
+
+
+def wal_checkpoint(pager):
+    # move the latest image of every logged page into the database file, then empty the log,
+    # a batch still running gets its statements so far committed
+    wal_commit_latched(pager)
+    wal_sync(pager)
+
+    pages_written = 0
+    for page_num in sorted(pager.wal_index):
+        page = pager.pages.get(page_num)
+        if page is None:
+            pager.wal_file.seek(pager.wal_index[page_num] + WAL_FRAME_HEADER_SIZE, os.SEEK_SET)
+            page = pager.wal_file.read(PAGE_SIZE)
+        pager_write_page(pager, page_num, page)
+        pages_written += 1
+    pager.file_descriptor.flush()
+    os.fsync(pager.file_descriptor.fileno())
+
+    pager.wal_file.truncate(0)
+    pager.wal_index.clear()
+    return pages_written
+
+
+def pager_checkpoint(pager):
+    # write back dirty pages in file order and make them durable
+    if pager.wal_file is not None:
+        pages_written = wal_checkpoint(pager)
+        pager.last_checkpoint_time = time.time()
+        pager.num_checkpoints += 1
+        return pages_written
+
+    pages_written = 0
+    for page_num in sorted(pager.dirty_pages):
+        pager_flush(pager, page_num)
+        pages_written += 1
+    if pager.page_locations is not None:
+        compressed_write_map(pager)
+    pager.file_descriptor.flush()
+    os.fsync(pager.file_descriptor.fileno())
+
+    pager.last_checkpoint_time = time.time()
+    pager.num_checkpoints += 1
+    return pages_written
+
+
+def pager_maybe_checkpoint(pager):
+    # called between statements, checkpoint when enough work has piled up
+    pending_pages = len(pager.dirty_pages) + len(pager.wal_index) + pager.unmapped_page_writes
+    if pending_pages == 0:
+        return
+    if pending_pages >= pager.checkpoint_dirty_pages or \
+            time.time() - pager.last_checkpoint_time >= pager.checkpoint_interval:
+        pager_checkpoint(pager)
 
 
 def db_close(table):
     pager = table.pager
 
-    for i in range(pager.num_pages):
-        if not pager.pages[i]:
-            continue
-        pager_flush(pager, i)
+    if pager.wal_file is not None:
+        # a clean shutdown checkpoints everything, the empty log can go
+        pager_checkpoint(pager)
+        pager.wal_file.close()
+        os.remove(pager.wal_file.name)
+
+    for page_num in sorted(pager.dirty_pages):
+        if not pager.use_mmap:
+            pager_flush(pager, page_num)
+    pager.dirty_pages.clear()
+    if pager.page_locations is not None:
+        compressed_write_map(pager)
+    if pager.use_mmap:
+        # writes already landed in the os page cache
+        for page in pager.pages.values():
+            page.close()
+    pager.pages.clear()
+    if pager.slow_log is not None:
+        pager.slow_log.close()
+        pager.slow_log = None
 
     pager.file_descriptor.close()
-
-
-def do_meta_command(input_buffer, table):
+    if table.partitions is not None:
+        if table.partition_pool is not None:
+            table.partition_pool.close()
+            table.partition_pool.join()
+        for partition in table.partitions[1:]:
+            db_close(partition)
+
+
+def do_meta_command(input_buffer, table, writer):
+    if table.partitions is not None and input_buffer.buffer in PARTITION_META_COMMANDS:
+        for partition_num in range(len(table.partitions)):
+            print "Partition %d:" % partition_num
+            do_meta_command(input_buffer, table.partitions[partition_num], writer)
+        return META_COMMAND_SUCCESS
     if input_buffer.buffer == ".exit":
         db_close(table)
         exit(1)
     elif input_buffer.buffer == ".btree":
         print "Tree:"
-        print_tree(table.pager, 0, 0)
+        print_tree(table.pager, table.root_page_num, 0, table.layout)
         return META_COMMAND_SUCCESS
     elif input_buffer.buffer == ".constants":
         print "Constants:"
         print_constants()
         return META_COMMAND_SUCCESS
+    elif input_buffer.buffer == ".checkpoint":
+        pages_written = pager_checkpoint(table.pager)
+        print "Checkpoint complete, pages written: %d." % pages_written
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer[:6] == ".mode ":
+        format = input_buffer.buffer[6:].strip()
+        if format not in (OUTPUT_FORMAT_TEXT, OUTPUT_FORMAT_TSV, OUTPUT_FORMAT_BINARY):
+            print "Unknown output mode '%s'." % format
+            return META_COMMAND_SUCCESS
+        writer.format = format
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer[:8] == ".import ":
+        do_import(input_buffer, table)
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer in (".trace on", ".trace off"):
+        table.pager.tracing = input_buffer.buffer == ".trace on"
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer == ".stats":
+        if table.partitions is None:
+            print_stats(database_stats(table))
+            return META_COMMAND_SUCCESS
+        for partition_num in range(len(table.partitions)):
+            print "Partition %d:" % partition_num
+            stats = database_stats(table.partitions[partition_num])
+            stats["statement_latencies"] = {}
+            print_stats(stats)
+        # statements run on the whole table, their latencies aren't any one partition's
+        print "All partitions:"
+        print_statement_latencies(named_statement_latencies(table.pager))
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer == ".compression":
+        if table.pager.page_locations is None:
+            print "Database is not compressed."
+            return META_COMMAND_SUCCESS
+        num_pages, stored_bytes, ratio = compression_stats(table.pager)
+        print "Pages stored: %d, bytes stored: %d, compression ratio: %.2f, file size: %d." % \
+            (num_pages, stored_bytes, ratio, table.pager.file_length)
+        return META_COMMAND_SUCCESS
+    elif input_buffer.buffer == ".vacuum":
+        if table.partitions is not None:
+            print "Vacuum is not supported on a partitioned table."
+            return META_COMMAND_SUCCESS
+        pages_freed = do_vacuum(table)
+        print "Vacuum complete, pages freed: %d." % pages_freed
+        return META_COMMAND_SUCCESS
     else:
         return META_COMMAND_UNRECOGNIZED_COMMAND
 
 
+def read_import_rows(filename):
+    # one row per line, id username and email separated by a tab or a comma
+    rows = []
+    for line in open(filename, "r"):
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        if "\t" in line:
+            fields = line.split("\t", 2)
+        else:
+            fields = line.split(",", 2)
+        if len(fields) < 3 or not fields[0].strip().lstrip("-").isdigit():
+            return None, PREPARE_SYNTAX_ERROR
+        row = Row(int(fields[0]), fields[1], fields[2])
+        result = validate_row(row)
+        if result != PREPARE_SUCCESS:
+            return None, result
+        rows.append(row)
+    return rows, PREPARE_SUCCESS
+
+
+def table_is_empty(table):
+    root = get_page(table.pager, table.root_page_num)
+    return get_node_type(root) == NODE_LEAF and leaf_node_num_cells(root) == 0
+
+
+def fill_leaf_node(node, entries, layout):
+    if layout.slotted:
+        content_start = PAGE_SIZE
+        for i in range(len(entries)):
+            key, row = entries[i]
+            cell = slotted_cell(row)
+            content_start -= len(cell)
+            node[content_start: content_start + len(cell)] = cell
+            SLOTTED_LEAF_NODE_SLOT.pack_into(node, leaf_node_cell_offset(i, layout), key, content_start)
+        set_slotted_leaf_node_content_start(node, content_start)
+        set_slotted_leaf_node_fragmented_bytes(node, 0)
+        set_leaf_node_num_cells(node, len(entries))
+        return
+
+    for i in range(len(entries)):
+        key, value = entries[i]
+        offset = leaf_node_cell_offset(i, layout)
+        pack_key(node, offset, key, layout)
+        if value is not None:
+            serialize_row(value, node, offset + layout.key_size)
+    set_leaf_node_num_cells(node, len(entries))
+
+
+def group_children(children, children_per_node):
+    # cut a level into as few nodes as possible, sharing the children evenly between them
+    num_groups = (len(children) + children_per_node - 1) / children_per_node
+    groups = []
+    start = 0
+    for i in range(num_groups):
+        end = start + (len(children) - start) / (num_groups - i)
+        groups.append(children[start: end])
+        start = end
+    return groups
+
+
+def bulk_load(table, entries, fill_factor):
+    # build the tree bottom-up from (key, value) entries sorted by key, the table must be empty
+    pager = table.pager
+    layout = table.layout
+    max_cells = layout.internal_node_max_cells
+    # at least three children per node so even sharing never leaves a node with one child
+    children_per_node = min(max_cells + 1, max(3, int(max_cells * fill_factor) + 1))
+
+    if leaf_entries_fit(entries, layout):
+        root = get_page(pager, table.root_page_num)
+        fill_leaf_node(root, entries, layout)
+        mark_page_dirty(pager, table.root_page_num)
+        return
+
+    # leaf level, each leaf linked to the next one
+    level = []
+    previous_page_num = None
+    for chunk in leaf_chunks(entries, layout, fill_factor):
+        page_num = get_unused_page_num(pager)
+        leaf = get_page(pager, page_num)
+        initialize_leaf_node(leaf)
+        fill_leaf_node(leaf, chunk, layout)
+        mark_page_dirty(pager, page_num)
+        if previous_page_num is not None:
+            set_leaf_node_next_leaf(get_page(pager, previous_page_num), page_num)
+            mark_page_dirty(pager, previous_page_num)
+        previous_page_num = page_num
+        level.append((page_num, chunk[-1][0]))
+
+    # internal levels until the remaining children fit under the root
+    while len(level) > max_cells + 1:
+        next_level = []
+        for group in group_children(level, children_per_node):
+            page_num = get_unused_page_num(pager)
+            next_level.append((page_num, group[-1][1]))
+            build_internal_node(pager, page_num, group, layout)
+        level = next_level
+
+    build_internal_node(pager, table.root_page_num, level, layout)
+    set_node_root(get_page(pager, table.root_page_num), True)
+
+
+def leaf_chunks(entries, layout, fill_factor):
+    # cut sorted entries into the runs that make up one leaf each
+    if not layout.slotted:
+        cells_per_leaf = max(1, int(layout.leaf_node_max_cells * fill_factor))
+        return [entries[start: start + cells_per_leaf] for start in range(0, len(entries), cells_per_leaf)]
+
+    space = int(SLOTTED_LEAF_NODE_SPACE_FOR_CELLS * fill_factor)
+    chunks = []
+    chunk = []
+    used = 0
+    for entry in entries:
+        size = leaf_entry_size(entry, layout)
+        if chunk and used + size > space:
+            chunks.append(chunk)
+            chunk = []
+            used = 0
+        chunk.append(entry)
+        used += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def build_internal_node(pager, page_num, children, layout):
+    node = get_page(pager, page_num)
+    pin_page(pager, page_num)
+    initialize_internal_node(node)
+    set_internal_node_children(node, children, layout)
+    for child_page_num, _ in children:
+        set_node_parent(get_page(pager, child_page_num), page_num)
+        mark_page_dirty(pager, child_page_num)
+    mark_page_dirty(pager, page_num)
+    unpin_page(pager, page_num)
+
+
+def do_import(input_buffer, table):
+    args = input_buffer.buffer.split(" ")
+    filename = args[1]
+    fill_factor = DEFAULT_IMPORT_FILL_FACTOR
+    if len(args) > 2:
+        try:
+            fill_factor = float(args[2])
+        except ValueError:
+            fill_factor = None
+        # a leaf can't be filled past full or left empty
+        if fill_factor is None or not 0 < fill_factor <= 1:
+            print "Fill factor must be greater than 0 and at most 1."
+            return
+    if not os.path.exists(filename):
+        print "Could not open file '%s'." % filename
+        return
+
+    rows, result = read_import_rows(filename)
+    if result == PREPARE_NEGATIVE_ID:
+        print "ID must be positive."
+        return
+    elif result == PREPARE_STRING_TOO_LONG:
+        print "String is too long."
+        return
+    elif result == PREPARE_SYNTAX_ERROR:
+        print "Syntax error. Could not parse import file."
+        return
+
+    if any(rows[i - 1].id > rows[i].id for i in range(1, len(rows))):
+        rows.sort(key=lambda row: row.id)
+    if any(rows[i - 1].id == rows[i].id for i in range(1, len(rows))):
+        print "Error: Duplicate key."
+        return
+
+    targets = [(table, rows)]
+    if table.partitions is not None:
+        targets = partition_rows(table, rows)
+    # a key already in any of the tables rejects the whole file before anything is written
+    if any(table_has_any_key(target, [row.id for row in target_rows]) for target, target_rows in targets):
+        print "Error: Duplicate key."
+        return
+    for target, target_rows in targets:
+        if table_is_empty(target):
+            bulk_load(target, [(row.id, row) for row in target_rows], fill_factor)
+            update_indexes(target, target_rows)
+            wal_commit(target.pager)
+        else:
+            # rows have to merge with the existing tree
+            insert_rows(target_rows, target)
+    print "Imported %d rows." % len(rows)
+
+
+def do_vacuum(table):
+    # rewrite the database packed and without free pages, the rename swaps it in atomically
+    pager = table.pager
+    filename = pager.file_descriptor.name
+    vacuum_filename = filename + VACUUM_SUFFIX
+    open(vacuum_filename, "wb").close()
+    leaf_format = LEAF_FORMAT_FIXED
+    if table.layout.slotted:
+        leaf_format = LEAF_FORMAT_SLOTTED
+    vacuum_table = db_open(vacuum_filename, leaf_format=leaf_format,
+                           compress=pager.page_locations is not None)
+    rows = [row for row in cursor_rows(table_start(table))]
+    bulk_load(vacuum_table, [(row.id, row) for row in rows], DEFAULT_IMPORT_FILL_FACTOR)
+    for column in sorted(table.indexes):
+        create_index(vacuum_table, column)
+    pager_checkpoint(vacuum_table.pager)
+    db_close(vacuum_table)
+
+    num_pages = pager.num_pages
+    use_wal = pager.wal_file is not None
+    # closing the table closes its slow log, the reopened one appends to the same file
+    slow_log = pager.slow_log
+    db_close(table)
+    os.rename(vacuum_filename, filename)
+    reopened_table = db_open(filename, pager.use_mmap, pager.max_cached_pages, use_wal)
+    reopened_pager = reopened_table.pager
+    reopened_pager.checkpoint_dirty_pages = pager.checkpoint_dirty_pages
+    reopened_pager.checkpoint_interval = pager.checkpoint_interval
+    reopened_pager.wal_commit_window = pager.wal_commit_window
+    reopened_pager.readahead_pages = pager.readahead_pages
+    reopened_pager.statement_latencies = pager.statement_latencies
+    reopened_pager.tracing = pager.tracing
+    if slow_log is not None:
+        slow_log_open(reopened_pager, slow_log.name, pager.slow_log_threshold)
+    table.pager = reopened_pager
+    table.indexes = reopened_table.indexes
+    return num_pages - reopened_pager.num_pages
+
+
+def validate_row(row):
+    if row.id < 0:
+        return PREPARE_NEGATIVE_ID
+    if len(row.username) > COLUMN_USERNAME_SIZE:
+        return PREPARE_STRING_TOO_LONG
+    if len(row.email) > COLUMN_EMAIL_SIZE:
+        return PREPARE_STRING_TOO_LONG
+    return PREPARE_SUCCESS
+
+
+def prepare_insert_values(input_buffer):
+    # insert values (1,user1,person1@example.com),(2,user2,person2@example.com)
+    values = input_buffer.buffer[len("insert values"):]
+    tuples = re.findall(r"\(([^()]*)\)", values)
+    if not tuples or re.sub(r"\([^()]*\)", "", values).replace(",", "").strip():
+        return None, PREPARE_SYNTAX_ERROR
+
+    rows = []
+    for fields in tuples:
+        fields = [field.strip() for field in fields.split(",", 2)]
+        if len(fields) < 3 or not fields[0].lstrip("-").isdigit():
+            return None, PREPARE_SYNTAX_ERROR
+        rows.append(Row(int(fields[0]), fields[1], fields[2]))
+    return prepare_insert_many(rows)
+
+
+def prepare_insert_many(rows):
+    statement = Statement(STATEMENT_INSERT)
+    for row in rows:
+        result = validate_row(row)
+        if result != PREPARE_SUCCESS:
+            return statement, result
+    statement.rows_to_insert = list(rows)
+    return statement, PREPARE_SUCCESS
+
+
 def prepare_insert(input_buffer):
+    if input_buffer.buffer[:13] == "insert values":
+        return prepare_insert_values(input_buffer)
+
     args = input_buffer.buffer.split(" ", 3)
     if len(args) < 4:
         return None, PREPARE_SYNTAX_ERROR
-    id = int(args[1])
-    username = args[2]
-    email = args[3]
 
     statement = Statement(STATEMENT_INSERT)
-    if id < 0:
-        return statement, PREPARE_NEGATIVE_ID
-    if len(username) > COLUMN_USERNAME_SIZE:
-        return statement, PREPARE_STRING_TOO_LONG
-    if len(email) > COLUMN_EMAIL_SIZE:
-        return statement, PREPARE_STRING_TOO_LONG
-
-    statement.row_to_insert = Row(id, username, email)
+    row = Row(int(args[1]), args[2], args[3])
+    result = validate_row(row)
+    if result != PREPARE_SUCCESS:
+        return statement, result
+
+    statement.row_to_insert = row
+    return statement, PREPARE_SUCCESS
+
+
+def prepare_select(input_buffer):
+    # select [count(*) | min(id) | max(id)] [where ...]
+    statement = Statement(STATEMENT_SELECT)
+    args = input_buffer.buffer.split()
+    if len(args) > 1 and args[1] in AGGREGATES:
+        statement.aggregate = args.pop(1)
+    if len(args) == 1:
+        return statement, PREPARE_SUCCESS
+    if args[1] != "where":
+        return None, PREPARE_SYNTAX_ERROR
+    return prepare_where(statement, args[2:])
+
+
+def prepare_where(statement, args):
+    # id = N | id between A and B | id >= A | id > A | id <= B | id < B
+    # username = 'x' | username like 'x%', the same for email
+    if len(args) == 3 and args[0] in INDEX_COLUMNS:
+        return prepare_where_column(statement, args)
+    if len(args) < 3 or args[0] != "id":
+        return None, PREPARE_SYNTAX_ERROR
+
+    operator = args[1]
+    try:
+        values = [int(arg) for arg in args[2::2]]
+    except ValueError:
+        return None, PREPARE_SYNTAX_ERROR
+    if operator == "between":
+        if len(args) != 5 or args[3] != "and":
+            return None, PREPARE_SYNTAX_ERROR
+        statement.key_min, statement.key_max = values
+        return statement, PREPARE_SUCCESS
+    if len(args) != 3:
+        return None, PREPARE_SYNTAX_ERROR
+
+    value = values[0]
+    if operator == "=":
+        statement.key_min = value
+        statement.key_max = value
+    elif operator == ">=":
+        statement.key_min = value
+    elif operator == ">":
+        statement.key_min = value + 1
+    elif operator == "<=":
+        statement.key_max = value
+    elif operator == "<":
+        statement.key_max = value - 1
+    else:
+        return None, PREPARE_SYNTAX_ERROR
+    return statement, PREPARE_SUCCESS
+
+
+def unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+
+def prepare_where_column(statement, args):
+    operator = args[1]
+    value = unquote(args[2])
+    if operator == "like":
+        if not value.endswith("%"):
+            return None, PREPARE_SYNTAX_ERROR
+        statement.column_prefix = True
+        value = value[:-1]
+    elif operator != "=":
+        return None, PREPARE_SYNTAX_ERROR
+    statement.column = args[0]
+    statement.column_value = value
+    return statement, PREPARE_SUCCESS
+
+
+def prepare_delete(input_buffer):
+    # delete [where id ...]
+    statement = Statement(STATEMENT_DELETE)
+    args = input_buffer.buffer.split()
+    if len(args) == 1:
+        return statement, PREPARE_SUCCESS
+    if args[1] != "where":
+        return None, PREPARE_SYNTAX_ERROR
+    statement, result = prepare_where(statement, args[2:])
+    if result == PREPARE_SUCCESS and statement.column is not None:
+        return None, PREPARE_SYNTAX_ERROR
+    return statement, result
+
+
+def prepare_update(input_buffer):
+    # update set username = x, email = y [where id ...]
+    match = re.match(r"update\s+set\s+(.*?)(?:\s+where\s+(.*))?$", input_buffer.buffer)
+    if match is None:
+        return None, PREPARE_SYNTAX_ERROR
+
+    statement = Statement(STATEMENT_UPDATE)
+    statement.assignments = {}
+    for assignment in match.group(1).split(","):
+        fields = [field.strip() for field in assignment.split("=", 1)]
+        if len(fields) != 2 or fields[0] not in INDEX_COLUMNS or not fields[1]:
+            return None, PREPARE_SYNTAX_ERROR
+        value = unquote(fields[1])
+        if len(value) > INDEX_COLUMNS[fields[0]][1]:
+            return None, PREPARE_STRING_TOO_LONG
+        statement.assignments[fields[0]] = value
+
+    if match.group(2) is None:
+        return statement, PREPARE_SUCCESS
+    statement, result = prepare_where(statement, match.group(2).split())
+    if result == PREPARE_SUCCESS and statement.column is not None:
+        return None, PREPARE_SYNTAX_ERROR
+    return statement, result
+
+
+def prepare_create_index(input_buffer):
+    # create index on username | email
+    args = input_buffer.buffer.split()
+    if len(args) != 4 or args[1] != "index" or args[2] != "on" or args[3] not in INDEX_COLUMNS:
+        return None, PREPARE_SYNTAX_ERROR
+    statement = Statement(STATEMENT_CREATE_INDEX)
+    statement.column = args[3]
     return statement, PREPARE_SUCCESS
 
 
 def prepare_statement(input_buffer):
     if input_buffer.buffer[:6] == "insert":
         return prepare_insert(input_buffer)
-    elif input_buffer.buffer == "select":
-        return Statement(STATEMENT_SELECT), PREPARE_SUCCESS
+    elif input_buffer.buffer[:6] == "select":
+        return prepare_select(input_buffer)
+    elif input_buffer.buffer[:6] == "create":
+        return prepare_create_index(input_buffer)
+    elif input_buffer.buffer[:6] == "delete":
+        return prepare_delete(input_buffer)
+    elif input_buffer.buffer[:6] == "update":
+        return prepare_update(input_buffer)
     else:
         return None, PREPARE_UNRECOGNIZED_SUCCESS
 
 
-# until recycling free pages, new pages will always go onto the end of the database file
+def get_catalog_page_num(pager):
+    # the catalog is created on first use, the table root is always page 0
+    if pager.catalog_page_num == 0:
+        catalog_page_num = pager.num_pages
+        get_page(pager, catalog_page_num)
+        mark_page_dirty(pager, catalog_page_num)
+        set_node_parent(get_page(pager, 0), catalog_page_num)
+        mark_page_dirty(pager, 0)
+        pager.catalog_page_num = catalog_page_num
+    return pager.catalog_page_num
+
+
+# reuse a page from the free list, otherwise new pages go onto the end of the database file
+# a reused page comes back zeroed like a new one
 def get_unused_page_num(pager):
-    return pager.num_pages
+    if pager.catalog_page_num == 0:
+        return pager.num_pages
+    catalog = get_page(pager, pager.catalog_page_num)
+    page_num = UINT32.unpack_from(catalog, CATALOG_FIRST_FREE_PAGE_OFFSET)[0]
+    if page_num == 0:
+        return pager.num_pages
+
+    page = get_page(pager, page_num)
+    next_free_page_num = UINT32.unpack_from(page, FREE_PAGE_NEXT_OFFSET)[0]
+    page[:] = EMPTY_PAGE
+    mark_page_dirty(pager, page_num)
+
+    catalog = get_page(pager, pager.catalog_page_num)
+    num_free_pages = UINT32.unpack_from(catalog, CATALOG_NUM_FREE_PAGES_OFFSET)[0]
+    UINT32.pack_into(catalog, CATALOG_FIRST_FREE_PAGE_OFFSET, next_free_page_num)
+    UINT32.pack_into(catalog, CATALOG_NUM_FREE_PAGES_OFFSET, num_free_pages - 1)
+    mark_page_dirty(pager, pager.catalog_page_num)
+    return page_num
+
+
+def free_page(pager, page_num):
+    # push the page onto the free list
+    catalog_page_num = get_catalog_page_num(pager)
+    catalog = get_page(pager, catalog_page_num)
+    first_free_page_num = UINT32.unpack_from(catalog, CATALOG_FIRST_FREE_PAGE_OFFSET)[0]
+    num_free_pages = UINT32.unpack_from(catalog, CATALOG_NUM_FREE_PAGES_OFFSET)[0]
+    UINT32.pack_into(catalog, CATALOG_FIRST_FREE_PAGE_OFFSET, page_num)
+    UINT32.pack_into(catalog, CATALOG_NUM_FREE_PAGES_OFFSET, num_free_pages + 1)
+    mark_page_dirty(pager, catalog_page_num)
+
+    page = get_page(pager, page_num)
+    page[:] = EMPTY_PAGE
+    UINT32.pack_into(page, FREE_PAGE_NEXT_OFFSET, first_free_page_num)
+    mark_page_dirty(pager, page_num)
 
 
 def create_new_root(table, right_child_page_num):
@@ -544,263 +2283,1454 @@ def create_new_root(table, right_child_page_num):
     # address of right child passed in
     # re-initialize root page to contain the new root node
     # new root node points to two children
+    table.pager.root_splits += 1
     root = get_page(table.pager, table.root_page_num)
+    pin_page(table.pager, table.root_page_num)
     right_child = get_page(table.pager, right_child_page_num)
+    pin_page(table.pager, right_child_page_num)
     left_child_page_num = get_unused_page_num(table.pager)
     left_child = get_page(table.pager, left_child_page_num)
+    pin_page(table.pager, left_child_page_num)
 
     # left child has data copied from old root
-    left_child = root
-    left_child = set_node_root(left_child, False)
+    left_child[:] = root[:]
+    set_node_root(left_child, False)
+    layout = table.layout
+    if get_node_type(left_child) == NODE_INTERNAL:
+        for i in range(internal_node_num_keys(left_child) + 1):
+            child_page_num = internal_node_child(left_child, i, layout)
+            child = get_page(table.pager, child_page_num)
+            set_node_parent(child, left_child_page_num)
+            mark_page_dirty(table.pager, child_page_num)
 
     # root node is a new internal node with one key and two children
-    root = initialize_internal_node(root)
-    root = set_node_root(root, True)
-    # set internal node num key
-    buf = struct.pack("I", 1)
-    root = modify_memory(root, buf, INTERNAL_NODE_NUM_KEYS_OFFSET)
-    # set internal node child
-    buf = struct.pack("I", left_child_page_num)
-    num_keys = internal_node_num_keys(root)
-    if num_keys < 0:
-        print "Tried to access child_num %d > num_keys %d" % (0, num_keys)
-        exit(0)
-    elif num_keys == 0:
-        root = modify_memory(root, buf, INTERNAL_NODE_RIGHT_CHILD_OFFSET)
-    else:
-        root = modify_memory(root, buf, INTERNAL_NODE_HEADER_SIZE)
-    # set internal node key
-    left_child_max_key = get_node_max_key(left_child)
-    buf = struct.pack("I", left_child_max_key)
-    root = modify_memory(root, buf, INTERNAL_NODE_HEADER_SIZE + INTERNAL_NODE_CHILD_SIZE)
-    # set internal node right child
-    buf = struct.pack("I", right_child_page_num)
-    root = modify_memory(root, buf, INTERNAL_NODE_RIGHT_CHILD_OFFSET)
+    initialize_internal_node(root)
+    set_node_root(root, True)
+    set_internal_node_num_keys(root, 1)
+    set_internal_node_child(root, 0, left_child_page_num, layout)
+    left_child_max_key = get_node_max_key(table.pager, left_child, layout)
+    set_internal_node_key(root, 0, left_child_max_key, layout)
+    set_internal_node_right_child(root, right_child_page_num)
 
     # update node parent
-    buf = struct.pack("I", table.root_page_num)
-    right_child = modify_memory(right_child, buf, PARENT_POINTER_OFFSET)
-    left_child = modify_memory(left_child, buf, PARENT_POINTER_OFFSET)
+    set_node_parent(left_child, table.root_page_num)
+    set_node_parent(right_child, table.root_page_num)
+
+    mark_page_dirty(table.pager, table.root_page_num)
+    mark_page_dirty(table.pager, left_child_page_num)
+    mark_page_dirty(table.pager, right_child_page_num)
 
-    table.pager.pages[table.root_page_num] = root
-    table.pager.pages[right_child_page_num] = right_child
-    table.pager.pages[left_child_page_num] = left_child
+    unpin_page(table.pager, left_child_page_num)
+    unpin_page(table.pager, right_child_page_num)
+    unpin_page(table.pager, table.root_page_num)
 
 
 def internal_node_insert(table, parent_page_num, child_page_num):
     # add a new child/key pair to parent that corresponds to child
 
+    layout = table.layout
     parent = get_page(table.pager, parent_page_num)
-    child = get_page(table.pager, child_page_num)
-    child_max_key = get_node_max_key(child)
-    index = internal_node_find_child(parent, child_max_key)
-
     original_num_keys = internal_node_num_keys(parent)
-    # update internal node num keys
-    buf = struct.pack("I", original_num_keys + 1)
-    parent = modify_memory(parent, buf, INTERNAL_NODE_NUM_KEYS_OFFSET)
+    if original_num_keys >= layout.internal_node_max_cells:
+        internal_node_split_and_insert(table, parent_page_num, child_page_num)
+        return
 
-    if original_num_keys >= INTERNAL_NODE_MAX_CELLS:
-        print "Need to implement splitting internal node"
-        exit(0)
+    pin_page(table.pager, parent_page_num)
+    child = get_page(table.pager, child_page_num)
+    child_max_key = get_node_max_key(table.pager, child, layout)
+    index = internal_node_find_child(parent, child_max_key, layout)
+
+    set_internal_node_num_keys(parent, original_num_keys + 1)
 
     right_child_page_num = internal_node_right_child(parent)
     right_child = get_page(table.pager, right_child_page_num)
+    right_child_max_key = get_node_max_key(table.pager, right_child, layout)
 
-    if child_max_key > get_node_max_key(right_child):
+    if child_max_key > right_child_max_key:
         # replace right child
-        #   update internal node child
-        buf = struct.pack("I", right_child_page_num)
-        num_keys = internal_node_num_keys(parent)
-        if num_keys < original_num_keys:
-            print "Tried to access child_num %d > num_keys %d" % (original_num_keys, num_keys)
-            exit(0)
-        elif num_keys == original_num_keys:
-            parent = modify_memory(parent, buf, INTERNAL_NODE_RIGHT_CHILD_OFFSET)
-        else:
-            offset = INTERNAL_NODE_HEADER_SIZE + original_num_keys * INTERNAL_NODE_CELL_SIZE
-            parent = modify_memory(parent, buf, offset)
-
-        #   update internal node key
-        buf = struct.pack("I", get_node_max_key(right_child))
-        offset = INTERNAL_NODE_HEADER_SIZE + original_num_keys * INTERNAL_NODE_CELL_SIZE + INTERNAL_NODE_CHILD_SIZE
-        parent = modify_memory(parent, buf, offset)
-
-        #   update internal node right child
-        buf = struct.pack("I", child_page_num)
-        parent = modify_memory(parent, buf, INTERNAL_NODE_RIGHT_CHILD_OFFSET)
+        set_internal_node_child(parent, original_num_keys, right_child_page_num, layout)
+        set_internal_node_key(parent, original_num_keys, right_child_max_key, layout)
+        set_internal_node_right_child(parent, child_page_num)
     else:
         # make room for the new cell
-        for i in range(original_num_keys, index, -1):
-            buf = internal_node_cell(parent, i - 1)
-            offset = INTERNAL_NODE_HEADER_SIZE + i * INTERNAL_NODE_CELL_SIZE
-            parent = modify_memory(parent, buf, offset)
-
-        # update internal node child
-        buf = struct.pack("I", child_page_num)
-        num_keys = internal_node_num_keys(parent)
-        if num_keys < index:
-            print "Tried to access child_num %d > num_keys %d" % (index, num_keys)
-            exit(0)
-        elif num_keys == index:
-            parent = modify_memory(parent, buf, INTERNAL_NODE_RIGHT_CHILD_OFFSET)
-        else:
-            offset = INTERNAL_NODE_HEADER_SIZE + index * INTERNAL_NODE_CELL_SIZE
-            parent = modify_memory(parent, buf, offset)
+        cell_size = layout.internal_node_cell_size
+        start = internal_node_cell_offset(index, layout)
+        end = internal_node_cell_offset(original_num_keys, layout)
+        parent[start + cell_size: end + cell_size] = parent[start: end]
+
+        set_internal_node_child(parent, index, child_page_num, layout)
+        set_internal_node_key(parent, index, child_max_key, layout)
 
-        # update internal node key
-        buf = struct.pack("I", child_max_key)
-        offset = INTERNAL_NODE_HEADER_SIZE + index * INTERNAL_NODE_CELL_SIZE + INTERNAL_NODE_CHILD_SIZE
-        parent = modify_memory(parent, buf, offset)
+    mark_page_dirty(table.pager, parent_page_num)
+    unpin_page(table.pager, parent_page_num)
 
-    table.pager.pages[table.root_page_num] = parent
 
+def set_internal_node_children(node, children, layout):
+    # children is a list of (page_num, max_key), the last one becomes the right child
+    set_internal_node_num_keys(node, len(children) - 1)
+    for i in range(len(children) - 1):
+        child_page_num, child_max_key = children[i]
+        set_internal_node_child(node, i, child_page_num, layout)
+        set_internal_node_key(node, i, child_max_key, layout)
+    set_internal_node_right_child(node, children[-1][0])
 
-def update_internal_node_key(node, old_key, new_key):
-    old_child_index = internal_node_find_child(node, old_key)
-    # update internal node key
-    buf = struct.pack("I", new_key)
-    offset = INTERNAL_NODE_HEADER_SIZE + old_child_index * INTERNAL_NODE_CELL_SIZE + INTERNAL_NODE_CHILD_SIZE
-    return modify_memory(node, buf, offset)
+
+def internal_node_split_and_insert(table, parent_page_num, child_page_num):
+    # create a new internal node and move half the children over
+    # the new child goes wherever its max key belongs
+    # update grandparent or create a new root
+    pager = table.pager
+    layout = table.layout
+    pager.internal_splits += 1
+    old_node = get_page(pager, parent_page_num)
+    pin_page(pager, parent_page_num)
+    old_max = get_node_max_key(pager, old_node, layout)
+    child_max_key = get_node_max_key(pager, get_page(pager, child_page_num), layout)
+
+    # all children of the full node plus the new one, in key order
+    num_keys = internal_node_num_keys(old_node)
+    children = []
+    for i in range(num_keys):
+        children.append((internal_node_child(old_node, i, layout), internal_node_key(old_node, i, layout)))
+    children.append((internal_node_right_child(old_node), old_max))
+    if child_max_key > old_max:
+        children.append((child_page_num, child_max_key))
+    else:
+        children.insert(internal_node_find_child(old_node, child_max_key, layout),
+                        (child_page_num, child_max_key))
+
+    left_split_count = (len(children) + 1) / 2
+    new_page_num = get_unused_page_num(pager)
+    new_node = get_page(pager, new_page_num)
+    pin_page(pager, new_page_num)
+    initialize_internal_node(new_node)
+    set_node_parent(new_node, node_parent(old_node))
+
+    set_internal_node_children(old_node, children[:left_split_count], layout)
+    set_internal_node_children(new_node, children[left_split_count:], layout)
+    for moved_page_num, _ in children[left_split_count:]:
+        set_node_parent(get_page(pager, moved_page_num), new_page_num)
+        mark_page_dirty(pager, moved_page_num)
+    mark_page_dirty(pager, parent_page_num)
+    mark_page_dirty(pager, new_page_num)
+
+    splitting_root = is_node_root(old_node)
+    grandparent_page_num = node_parent(old_node)
+    unpin_page(pager, new_page_num)
+    unpin_page(pager, parent_page_num)
+
+    if splitting_root:
+        create_new_root(table, new_page_num)
+    else:
+        grandparent = get_page(pager, grandparent_page_num)
+
+        update_internal_node_key(grandparent, old_max, children[left_split_count - 1][1], layout)
+        mark_page_dirty(pager, grandparent_page_num)
+        internal_node_insert(table, grandparent_page_num, new_page_num)
+
+
+def update_internal_node_key(node, old_key, new_key, layout):
+    old_child_index = internal_node_find_child(node, old_key, layout)
+    # the right child has no key, writing one would run past a full node
+    if old_child_index < internal_node_num_keys(node):
+        set_internal_node_key(node, old_child_index, new_key, layout)
 
 
 def leaf_node_split_and_insert(cursor, key, value):
     # create a new node move half the cells over
     # insert the new value in one of the two nodes
     # update parent or create a new parent
+    layout = cursor.table.layout
+    cursor.table.pager.leaf_splits += 1
     old_node = get_page(cursor.table.pager, cursor.page_num)
-    old_max = get_node_max_key(old_node)
+    pin_page(cursor.table.pager, cursor.page_num)
+    old_max = get_node_max_key(cursor.table.pager, old_node, layout)
     new_page_num = get_unused_page_num(cursor.table.pager)
     new_node = get_page(cursor.table.pager, new_page_num)
-    new_node = initialize_leaf_node(new_node)
-    # update node parent
-    buf = struct.pack("I", node_parent(old_node))
-    new_node = modify_memory(new_node, buf, PARENT_POINTER_OFFSET)
-    # update leaf node next leaf
-    buf = struct.pack("I", leaf_node_next_leaf(old_node))
-    new_node = modify_memory(new_node, buf, LEAF_NODE_NEXT_LEAF_OFFSET)
-    # update leaf node next leaf
-    buf = struct.pack("I", new_page_num)
-    old_node = modify_memory(old_node, buf, LEAF_NODE_NEXT_LEAF_OFFSET)
-
-    # all existing keys plus new key should be divided evenly between old and new nodes
-    # starting from the right, move each key to correct position
-    for i in range(LEAF_NODE_MAX_CELLS, -1, -1):
-        index_within_node = i % LEAF_NODE_LEFT_SPLIT_COUNT
-
-        if i == cursor.cell_num:
-            # set leaf node value
-            value_buf = serialize_row(value)
-            value_offset = (LEAF_NODE_HEADER_SIZE + index_within_node * LEAF_NODE_CELL_SIZE) + LEAF_NODE_KEY_SIZE
-            # set leaf node key
-            key_buf = struct.pack("I", key)
-            key_offset = LEAF_NODE_HEADER_SIZE + index_within_node * LEAF_NODE_CELL_SIZE
-            if i > LEAF_NODE_LEFT_SPLIT_COUNT:
-                new_node = modify_memory(new_node, value_buf, value_offset)
-                new_node = modify_memory(new_node, key_buf, key_offset)
+    initialize_leaf_node(new_node)
+    set_node_parent(new_node, node_parent(old_node))
+    set_leaf_node_next_leaf(new_node, leaf_node_next_leaf(old_node))
+    set_leaf_node_next_leaf(old_node, new_page_num)
+
+    if layout.slotted:
+        # slotted leaves split by bytes, not by number of cells
+        entries = leaf_node_entries(old_node, layout)
+        entries.insert(cursor.cell_num, (key, value))
+        left_split_count = leaf_entries_split_point(entries, layout)
+        fill_leaf_node(old_node, entries[:left_split_count], layout)
+        fill_leaf_node(new_node, entries[left_split_count:], layout)
+    else:
+        # all existing keys plus new key should be divided evenly between old and new nodes
+        # starting from the right, move each key to correct position
+        cell_size = layout.leaf_node_cell_size
+        left_split_count = layout.leaf_node_left_split_count
+        for i in range(layout.leaf_node_max_cells, -1, -1):
+            if i >= left_split_count:
+                destination_node = new_node
             else:
-                old_node = modify_memory(old_node, value_buf, value_offset)
-                old_node = modify_memory(old_node, key_buf, key_offset)
-            continue
-        elif i > cursor.cell_num:
-            pos = LEAF_NODE_HEADER_SIZE + (i - 1) * LEAF_NODE_CELL_SIZE
-            buf = old_node[pos: pos + LEAF_NODE_CELL_SIZE]
-        else:
-            pos = LEAF_NODE_HEADER_SIZE + i * LEAF_NODE_CELL_SIZE
-            buf = old_node[pos: pos + LEAF_NODE_CELL_SIZE]
-
-        offset = LEAF_NODE_HEADER_SIZE + index_within_node * LEAF_NODE_CELL_SIZE
-        if i >= LEAF_NODE_LEFT_SPLIT_COUNT:
-            new_node = modify_memory(new_node, buf, offset)
-        else:
-            old_node = modify_memory(old_node, buf, offset)
+                destination_node = old_node
+            index_within_node = i % left_split_count
+            offset = leaf_node_cell_offset(index_within_node, layout)
+
+            if i == cursor.cell_num:
+                set_leaf_node_key(destination_node, index_within_node, key, layout)
+                if value is not None:
+                    serialize_row(value, destination_node, offset + layout.key_size)
+            elif i > cursor.cell_num:
+                destination_node[offset: offset + cell_size] = leaf_node_cell(old_node, i - 1, layout)
+            else:
+                destination_node[offset: offset + cell_size] = leaf_node_cell(old_node, i, layout)
 
-    # update cell count on both leaf nodes
-    buf = struct.pack("I", LEAF_NODE_LEFT_SPLIT_COUNT)
-    old_node = modify_memory(old_node, buf, LEAF_NODE_NUM_CELLS_OFFSET)
-    buf = struct.pack("I", LEAF_NODE_RIGHT_SPLIT_COUNT)
-    new_node = modify_memory(new_node, buf, LEAF_NODE_NUM_CELLS_OFFSET)
+        # update cell count on both leaf nodes
+        set_leaf_node_num_cells(old_node, left_split_count)
+        set_leaf_node_num_cells(new_node, layout.leaf_node_right_split_count)
+    mark_page_dirty(cursor.table.pager, cursor.page_num)
+    mark_page_dirty(cursor.table.pager, new_page_num)
 
-    cursor.table.pager.pages[cursor.page_num] = old_node
-    cursor.table.pager.pages[new_page_num] = new_node
+    splitting_root = is_node_root(old_node)
+    parent_page_num = node_parent(old_node)
+    new_max = get_node_max_key(cursor.table.pager, old_node, layout)
+    unpin_page(cursor.table.pager, cursor.page_num)
 
-    if is_node_root(old_node):
+    if splitting_root:
         create_new_root(cursor.table, new_page_num)
         return
     else:
-        parent_page_num = node_parent(old_node)
-        new_max = get_node_max_key(old_node)
         parent = get_page(cursor.table.pager, parent_page_num)
 
-        parent = update_internal_node_key(parent, old_max, new_max)
-
-        cursor.table.pager.pages[parent_page_num] = parent
+        update_internal_node_key(parent, old_max, new_max, layout)
+        mark_page_dirty(cursor.table.pager, parent_page_num)
         internal_node_insert(cursor.table, parent_page_num, new_page_num)
         return
 
 
 def leaf_node_insert(cursor, key, value):
+    # value is the row of a table cell, index cells have none
+    layout = cursor.table.layout
     node = get_page(cursor.table.pager, cursor.page_num)
 
-    num_cells = leaf_node_num_cells(node)
-    if num_cells >= LEAF_NODE_MAX_CELLS:
+    if not leaf_node_has_room(node, value, layout):
         # node full
         leaf_node_split_and_insert(cursor, key, value)
         return
+    if layout.slotted:
+        slotted_leaf_node_insert(node, cursor.cell_num, key, value, layout)
+        mark_page_dirty(cursor.table.pager, cursor.page_num)
+        return
 
+    num_cells = leaf_node_num_cells(node)
     if cursor.cell_num < num_cells:
         # Make room for new cell
-        for i in range(num_cells, cursor.cell_num, -1):
-            offset = LEAF_NODE_HEADER_SIZE + i * LEAF_NODE_CELL_SIZE
-            node = modify_memory(node, leaf_node_cell(node, i - 1), offset)
+        start = leaf_node_cell_offset(cursor.cell_num, layout)
+        end = leaf_node_cell_offset(num_cells, layout)
+        node[start + layout.leaf_node_cell_size: end + layout.leaf_node_cell_size] = node[start: end]
 
-    # update num cells
-    buf = struct.pack("I", leaf_node_num_cells(node) + 1)
-    node = modify_memory(node, buf, LEAF_NODE_NUM_CELLS_OFFSET)
-    # insert node key
-    buf = struct.pack("I", key)
-    offset = LEAF_NODE_HEADER_SIZE + cursor.cell_num * LEAF_NODE_CELL_SIZE
-    node = modify_memory(node, buf, offset)
-    # insert node value
-    buf = serialize_row(value)
-    offset = (LEAF_NODE_HEADER_SIZE + cursor.cell_num * LEAF_NODE_CELL_SIZE) + LEAF_NODE_KEY_SIZE
-    node = modify_memory(node, buf, offset)
+    set_leaf_node_num_cells(node, num_cells + 1)
+    set_leaf_node_key(node, cursor.cell_num, key, layout)
+    if value is not None:
+        serialize_row(value, node, leaf_node_cell_offset(cursor.cell_num, layout) + layout.key_size)
+    mark_page_dirty(cursor.table.pager, cursor.page_num)
 
-    cursor.table.pager.pages[cursor.page_num] = node
 
+def slotted_leaf_node_insert(node, cell_num, key, row, layout):
+    cell = slotted_cell(row)
+    num_cells = leaf_node_num_cells(node)
+    if slotted_leaf_node_content_start(node) - leaf_node_cell_offset(num_cells + 1, layout) < len(cell):
+        # the room left is in holes of deleted cells, compact the page first
+        fill_leaf_node(node, leaf_node_entries(node, layout), layout)
+    content_start = slotted_leaf_node_content_start(node) - len(cell)
+    node[content_start: content_start + len(cell)] = cell
+    set_slotted_leaf_node_content_start(node, content_start)
+
+    # make room for the new slot
+    start = leaf_node_cell_offset(cell_num, layout)
+    end = leaf_node_cell_offset(num_cells, layout)
+    node[start + layout.leaf_node_cell_size: end + layout.leaf_node_cell_size] = node[start: end]
+    SLOTTED_LEAF_NODE_SLOT.pack_into(node, start, key, content_start)
+    set_leaf_node_num_cells(node, num_cells + 1)
+
+
+def tree_delete(table, key):
+    # remove a key from the tree, False when it is not there
+    cursor = table_find(table, key)
+    node = get_page(table.pager, cursor.page_num)
+    if cursor.cell_num >= leaf_node_num_cells(node) or \
+            leaf_node_key(node, cursor.cell_num, table.layout) != key:
+        return False
+    leaf_node_delete(cursor)
+    return True
+
+
+def leaf_node_delete(cursor):
+    pager = cursor.table.pager
+    layout = cursor.table.layout
+    node = get_page(pager, cursor.page_num)
 
-def execute_insert(statement, table):
-    node = get_page(table.pager, table.root_page_num)
     num_cells = leaf_node_num_cells(node)
+    if layout.slotted:
+        # the cell itself stays behind as a hole until the page is compacted
+        cell_offset = slotted_leaf_node_cell_offset(node, cursor.cell_num, layout)
+        fragmented_bytes = slotted_leaf_node_fragmented_bytes(node) + slotted_cell_size(node, cell_offset)
+        set_slotted_leaf_node_fragmented_bytes(node, fragmented_bytes)
+    cell_size = layout.leaf_node_cell_size
+    start = leaf_node_cell_offset(cursor.cell_num + 1, layout)
+    end = leaf_node_cell_offset(num_cells, layout)
+    node[start - cell_size: end - cell_size] = node[start: end]
+    set_leaf_node_num_cells(node, num_cells - 1)
+    mark_page_dirty(pager, cursor.page_num)
 
-    row_to_insert = statement.row_to_insert
-    key_to_insert = row_to_insert.id
-    cursor = table_find(table, key_to_insert)
+    # keys of a parent may now be larger than the max of their child, they still separate the children
+    if not is_node_root(node) and leaf_node_is_underfull(node, layout):
+        rebalance_node(cursor.table, cursor.page_num)
+
+
+def internal_node_min_children(layout):
+    return max(2, (layout.internal_node_max_cells + 1) / 2)
+
+
+def internal_node_children(pager, node, layout):
+    # (page_num, max_key) of every child, the format set_internal_node_children takes
+    num_keys = internal_node_num_keys(node)
+    children = []
+    for i in range(num_keys):
+        children.append((internal_node_child(node, i, layout), internal_node_key(node, i, layout)))
+    right_child_page_num = internal_node_right_child(node)
+    right_child_max_key = get_node_max_key(pager, get_page(pager, right_child_page_num), layout)
+    children.append((right_child_page_num, right_child_max_key))
+    return children
+
+
+def rebalance_node(table, page_num):
+    # an underfull node merges with a sibling, or takes cells from it when both do not fit in one node
+    pager = table.pager
+    layout = table.layout
+    parent_page_num = node_parent(get_page(pager, page_num))
+    parent = get_page(pager, parent_page_num)
+    pin_page(pager, parent_page_num)
+
+    num_keys = internal_node_num_keys(parent)
+    index = 0
+    while internal_node_child(parent, index, layout) != page_num:
+        index += 1
+    left_index = max(index - 1, 0)
+    left_page_num = internal_node_child(parent, left_index, layout)
+    right_page_num = internal_node_child(parent, left_index + 1, layout)
+    pin_page(pager, left_page_num)
+    pin_page(pager, right_page_num)
+
+    if get_node_type(get_page(pager, page_num)) == NODE_LEAF:
+        merged, left_max_key = leaf_nodes_rebalance(table, left_page_num, right_page_num)
+    else:
+        merged, left_max_key = internal_nodes_rebalance(table, left_page_num, right_page_num)
+
+    if merged:
+        # the right node's slot now leads to the left node, the left node's own cell goes away
+        set_internal_node_child(parent, left_index + 1, left_page_num, layout)
+        start = internal_node_cell_offset(left_index + 1, layout)
+        end = internal_node_cell_offset(num_keys, layout)
+        cell_size = layout.internal_node_cell_size
+        parent[start - cell_size: end - cell_size] = parent[start: end]
+        set_internal_node_num_keys(parent, num_keys - 1)
+    else:
+        set_internal_node_key(parent, left_index, left_max_key, layout)
+    mark_page_dirty(pager, parent_page_num)
+
+    parent_is_root = is_node_root(parent)
+    unpin_page(pager, right_page_num)
+    unpin_page(pager, left_page_num)
+    unpin_page(pager, parent_page_num)
+    if not merged:
+        return
+
+    free_page(pager, right_page_num)
+    if parent_is_root:
+        if num_keys - 1 == 0:
+            collapse_root(table)
+    elif num_keys < internal_node_min_children(layout):
+        rebalance_node(table, parent_page_num)
+
+
+def leaf_nodes_rebalance(table, left_page_num, right_page_num):
+    # returns whether the right leaf was merged into the left one, and the new max key of the left leaf
+    pager = table.pager
+    layout = table.layout
+    left = get_page(pager, left_page_num)
+    right = get_page(pager, right_page_num)
+    if layout.slotted:
+        return slotted_leaf_nodes_rebalance(table, left_page_num, right_page_num)
+    left_num_cells = leaf_node_num_cells(left)
+    right_num_cells = leaf_node_num_cells(right)
+    num_cells = left_num_cells + right_num_cells
+
+    if num_cells <= layout.leaf_node_max_cells:
+        left[leaf_node_cell_offset(left_num_cells, layout): leaf_node_cell_offset(num_cells, layout)] = \
+            right[LEAF_NODE_HEADER_SIZE: leaf_node_cell_offset(right_num_cells, layout)]
+        set_leaf_node_num_cells(left, num_cells)
+        set_leaf_node_next_leaf(left, leaf_node_next_leaf(right))
+        mark_page_dirty(pager, left_page_num)
+        return True, None
+
+    # share the cells of both leaves evenly
+    cells = left[LEAF_NODE_HEADER_SIZE: leaf_node_cell_offset(left_num_cells, layout)] + \
+        right[LEAF_NODE_HEADER_SIZE: leaf_node_cell_offset(right_num_cells, layout)]
+    left_count = (num_cells + 1) / 2
+    split = left_count * layout.leaf_node_cell_size
+    left[LEAF_NODE_HEADER_SIZE: LEAF_NODE_HEADER_SIZE + split] = cells[:split]
+    right[LEAF_NODE_HEADER_SIZE: LEAF_NODE_HEADER_SIZE + len(cells) - split] = cells[split:]
+    set_leaf_node_num_cells(left, left_count)
+    set_leaf_node_num_cells(right, num_cells - left_count)
+    mark_page_dirty(pager, left_page_num)
+    mark_page_dirty(pager, right_page_num)
+    return False, leaf_node_key(left, left_count - 1, layout)
+
+
+def slotted_leaf_nodes_rebalance(table, left_page_num, right_page_num):
+    pager = table.pager
+    layout = table.layout
+    left = get_page(pager, left_page_num)
+    right = get_page(pager, right_page_num)
+    entries = leaf_node_entries(left, layout) + leaf_node_entries(right, layout)
+
+    if leaf_entries_fit(entries, layout):
+        fill_leaf_node(left, entries, layout)
+        set_leaf_node_next_leaf(left, leaf_node_next_leaf(right))
+        mark_page_dirty(pager, left_page_num)
+        return True, None
+
+    # share the bytes of both leaves evenly
+    left_count = leaf_entries_split_point(entries, layout)
+    fill_leaf_node(left, entries[:left_count], layout)
+    fill_leaf_node(right, entries[left_count:], layout)
+    mark_page_dirty(pager, left_page_num)
+    mark_page_dirty(pager, right_page_num)
+    return False, entries[left_count - 1][0]
+
+
+def internal_nodes_rebalance(table, left_page_num, right_page_num):
+    # returns whether the right node was merged into the left one, and the new max key of the left node
+    pager = table.pager
+    layout = table.layout
+    left = get_page(pager, left_page_num)
+    right = get_page(pager, right_page_num)
+    left_children = internal_node_children(pager, left, layout)
+    right_children = internal_node_children(pager, right, layout)
+    children = left_children + right_children
+
+    if len(children) <= layout.internal_node_max_cells + 1:
+        set_internal_node_children(left, children, layout)
+        mark_page_dirty(pager, left_page_num)
+        for child_page_num, _ in right_children:
+            set_node_parent(get_page(pager, child_page_num), left_page_num)
+            mark_page_dirty(pager, child_page_num)
+        return True, None
+
+    # share the children of both nodes evenly
+    left_count = (len(children) + 1) / 2
+    set_internal_node_children(left, children[:left_count], layout)
+    set_internal_node_children(right, children[left_count:], layout)
+    mark_page_dirty(pager, left_page_num)
+    mark_page_dirty(pager, right_page_num)
+    for i in range(len(children)):
+        moved_to_left = i < left_count and i >= len(left_children)
+        moved_to_right = i >= left_count and i < len(left_children)
+        if moved_to_left or moved_to_right:
+            child_page_num = children[i][0]
+            new_parent_page_num = left_page_num if moved_to_left else right_page_num
+            set_node_parent(get_page(pager, child_page_num), new_parent_page_num)
+            mark_page_dirty(pager, child_page_num)
+    return False, children[left_count - 1][1]
+
+
+def collapse_root(table):
+    # a root left with one child takes over the child's contents, the tree loses a level
+    pager = table.pager
+    root = get_page(pager, table.root_page_num)
+    pin_page(pager, table.root_page_num)
+    child_page_num = internal_node_right_child(root)
+    child = get_page(pager, child_page_num)
+
+    # the parent pointer of a root is not a parent, keep it
+    root_parent = node_parent(root)
+    root[:] = child[:]
+    set_node_root(root, True)
+    set_node_parent(root, root_parent)
+    mark_page_dirty(pager, table.root_page_num)
+    if get_node_type(root) == NODE_INTERNAL:
+        for i in range(internal_node_num_keys(root) + 1):
+            grandchild_page_num = internal_node_child(root, i, table.layout)
+            set_node_parent(get_page(pager, grandchild_page_num), table.root_page_num)
+            mark_page_dirty(pager, grandchild_page_num)
+    unpin_page(pager, table.root_page_num)
+
+    free_page(pager, child_page_num)
+
+
+def execute_insert(statement, table):
+    if statement.rows_to_insert is not None:
+        return execute_insert_rows(statement.rows_to_insert, table)
+    return execute_insert_rows([statement.row_to_insert], table)
 
-    if cursor.cell_num < num_cells:
-        key_at_index = leaf_node_key(node, cursor.cell_num)
-        if key_at_index == key_to_insert:
-            return EXECUTE_DUPLICATE_KEY
 
-    leaf_node_insert(cursor, row_to_insert.id, row_to_insert)
+def execute_insert_rows(rows, table):
+    # all of the rows go in or, when one has a duplicate key, none of them
+    rows = sorted(rows, key=lambda row: row.id)
+    if rows_have_duplicate_key(rows, table):
+        return EXECUTE_DUPLICATE_KEY
+    insert_rows(rows, table)
     return EXECUTE_SUCCESS
 
 
-def execute_select(table):
-    cursor = table_start(table)
+def rows_have_duplicate_key(rows, table):
+    # rows are in id order, checked before anything is written so a batch is never half applied
+    if any(rows[i - 1].id == rows[i].id for i in range(1, len(rows))):
+        return True
+    return table_has_any_key(table, [row.id for row in rows])
+
+
+def table_has_any_key(table, keys):
+    # keys are in order, consecutive keys reuse the leaf of the previous one instead of
+    # descending from the root again
+    leaf_keys = ()
+    for key in keys:
+        if not leaf_keys or key > leaf_keys[-1]:
+            cursor = table_find(table, key)
+            leaf_keys = leaf_node_keys(get_page(table.pager, cursor.page_num), table.layout)
+        cell_num = bisect.bisect_left(leaf_keys, key)
+        if cell_num < len(leaf_keys) and leaf_keys[cell_num] == key:
+            return True
+    return False
+
+
+def insert_rows(rows, table):
+    # rows are in id order and none of their keys is in the table
+    tree_insert_entries(table, [(row.id, row) for row in rows])
+    update_indexes(table, rows)
+    wal_commit(table.pager)
+
+
+def tree_insert_entries(table, entries):
+    # entries are (key, value) pairs in key order, consecutive keys reuse the leaf
+    # of the previous one instead of descending from the root again
+    # returns how many entries went in, a duplicate key stops the insert
+    pager = table.pager
+    layout = table.layout
+    cursor = None
+    for num_inserted in range(len(entries)):
+        key_to_insert, value = entries[num_inserted]
+        if cursor is not None:
+            node = get_page(pager, cursor.page_num)
+            num_cells = leaf_node_num_cells(node)
+            # keys above the leaf max may belong to the next leaf, only the rightmost leaf is unbounded
+            if key_to_insert <= leaf_node_key(node, num_cells - 1, layout) or leaf_node_next_leaf(node) == 0:
+                keys = leaf_node_keys(node, layout)
+                cursor.cell_num = bisect.bisect_left(keys, key_to_insert, cursor.cell_num)
+            else:
+                cursor = None
+        if cursor is None:
+            cursor = table_find(table, key_to_insert)
+            # the leaf the cursor landed on, the root may have been evicted by the descent
+            node = get_page(pager, cursor.page_num)
+            num_cells = leaf_node_num_cells(node)
+
+        if cursor.cell_num < num_cells:
+            key_at_index = leaf_node_key(node, cursor.cell_num, layout)
+            if key_at_index == key_to_insert:
+                return num_inserted
+
+        full = not leaf_node_has_room(node, value, layout)
+        leaf_node_insert(cursor, key_to_insert, value)
+        if full:
+            # the leaf split, the next key has to find its leaf again
+            cursor = None
+        else:
+            cursor.cell_num += 1
+
+    return len(entries)
+
+
+def index_key(column, row):
+    # column values are compared NUL padded, the way they come back out of a page
+    column_size = INDEX_COLUMNS[column][1]
+    return getattr(row, column).ljust(column_size, "\x00"), row.id
+
+
+def update_indexes(table, rows):
+    # add the entries of freshly inserted rows to every index of the table
+    for column, index in table.indexes.items():
+        entries = sorted([(index_key(column, row), None) for row in rows])
+        if table_is_empty(index):
+            bulk_load(index, entries, DEFAULT_IMPORT_FILL_FACTOR)
+        else:
+            tree_insert_entries(index, entries)
+
+
+def create_index(table, column):
+    pager = table.pager
+    catalog_page_num = get_catalog_page_num(pager)
+    index_page_num = get_unused_page_num(pager)
+    index_root = get_page(pager, index_page_num)
+    initialize_leaf_node(index_root)
+    set_node_root(index_root, True)
+    mark_page_dirty(pager, index_page_num)
+
+    catalog = get_page(pager, catalog_page_num)
+    num_indexes = UINT32.unpack_from(catalog, CATALOG_NUM_INDEXES_OFFSET)[0]
+    CATALOG_ENTRY.pack_into(catalog, CATALOG_HEADER_SIZE + num_indexes * CATALOG_ENTRY.size,
+                            INDEX_COLUMNS[column][0], index_page_num)
+    UINT32.pack_into(catalog, CATALOG_NUM_INDEXES_OFFSET, num_indexes + 1)
+    mark_page_dirty(pager, catalog_page_num)
+
+    index = Table(pager, index_page_num, INDEX_COLUMNS[column][2])
+    entries = sorted([(index_key(column, row), None) for row in cursor_rows(table_start(table))])
+    bulk_load(index, entries, DEFAULT_IMPORT_FILL_FACTOR)
+    table.indexes[column] = index
+
+
+def load_indexes(table):
+    # open every index listed in the catalog
+    pager = table.pager
+    if pager.catalog_page_num == 0:
+        return
+    catalog = get_page(pager, pager.catalog_page_num)
+    num_indexes = UINT32.unpack_from(catalog, CATALOG_NUM_INDEXES_OFFSET)[0]
+    for i in range(num_indexes):
+        offset = CATALOG_HEADER_SIZE + i * CATALOG_ENTRY.size
+        column_code, index_page_num = CATALOG_ENTRY.unpack_from(catalog, offset)
+        for column, (code, _, layout) in INDEX_COLUMNS.items():
+            if code == column_code:
+                table.indexes[column] = Table(pager, index_page_num, layout)
+
+
+def index_find_ids(index, column, value, prefix):
+    # ids of the entries whose column value equals value, or starts with it for a prefix match
+    column_size = INDEX_COLUMNS[column][1]
+    if not prefix:
+        value = value.ljust(column_size, "\x00")
+    cursor = table_seek(index, (value, 0))
+    ids = []
     while not cursor.end_of_table:
-        row = deserialize_row(cursor_value(cursor))
-        print_row(row)
-        cursor_advance(cursor)
+        node = get_page(index.pager, cursor.page_num)
+        keys = leaf_node_keys(node, index.layout)
+        for i in range(cursor.cell_num, len(keys)):
+            column_value, id = keys[i]
+            if column_value != value and not (prefix and column_value.startswith(value)):
+                return ids
+            ids.append(id)
+        next_page_num = leaf_node_next_leaf(node)
+        if next_page_num == 0:
+            break
+        cursor.page_num = next_page_num
+        cursor.cell_num = 0
+    return ids
+
+
+def executemany(table, rows):
+    # programmatic multi-row insert of Row objects, returns (prepare result, execute result)
+    statement, result = prepare_insert_many(rows)
+    if result != PREPARE_SUCCESS:
+        return result, None
+    return result, execute_insert(statement, table)
+
+
+def connect(filename, use_mmap=False, max_cached_pages=DEFAULT_CACHE_PAGES, use_wal=False,
+            mvcc=False):
+    # the first connection to a file opens it, later ones share its pager and lock,
+    # with mvcc selects read a snapshot and never wait for writers nor hold them up
+    path = os.path.realpath(filename)
+    with open_databases_lock:
+        database = open_databases.get(path)
+        if database is None:
+            open(path, "ab").close()
+            table = db_open(path, use_mmap, max_cached_pages, use_wal)
+            database = share_database(path, table, mvcc)
+        database.num_connections += 1
+    return Connection(database)
+
+
+def share_database(path, table, mvcc=False):
+    # latch the pager so threads can use it, the caller holds open_databases_lock
+    pager = table.pager
+    if mvcc and pager.use_mmap:
+        print "Snapshot reads are not supported in mmap mode."
+        exit(0)
+    if table.partitions is not None:
+        print "Partitioned tables are not supported by connect and --serve."
+        exit(0)
+    pager.cache_latch = threading.Lock()
+    # threads read pages in through get_page_latched only
+    pager.readahead_pages = 0
+    # reentrant, a checkpoint holding it commits the log first
+    pager.file_latch = threading.RLock()
+    pager.wal_sync_latch = threading.Lock()
+    if mvcc:
+        pager.snapshots = {}
+        pager.thread_state = threading.local()
+    database = Database(path, table)
+    open_databases[path] = database
+    return database
+
+
+def set_slow_log(connection, filename, threshold=DEFAULT_SLOW_LOG_THRESHOLD):
+    # log the slow statements of every connection sharing the database
+    pager = connection.database.table.pager
+    with pager.cache_latch:
+        if pager.slow_log is None:
+            slow_log_open(pager, filename, threshold)
+
+
+def close(connection):
+    # the last connection to a file closes it once the statements still running finish
+    database = connection.database
+    with open_databases_lock:
+        database.num_connections -= 1
+        if database.num_connections == 0:
+            write_lock_acquire(database.lock)
+            db_close(database.table)
+            del open_databases[database.path]
+            write_lock_release(database.lock)
+
+
+def execute(connection, sql):
+    # run one statement, returns (prepare result, execute result) like executemany,
+    # selects share the database with each other and anything else has it to itself
+    statement, result = prepare_statement(InputBuffer(sql))
+    if result != PREPARE_SUCCESS:
+        return result, None
+
+    database = connection.database
+    pager = database.table.pager
+    trace = trace_begin(pager, connection.tracing)
+    try:
+        return result, execute_locked(connection, statement)
+    finally:
+        trace_end(pager, trace, sql)
+        connection.last_trace = trace
+
+
+def execute_locked(connection, statement):
+    database = connection.database
+    pager = database.table.pager
+    if statement.type == STATEMENT_SELECT:
+        return read_database(connection, lambda table: execute_statement(statement, table, connection.writer))
+
+    write_lock_acquire(database.lock)
+    try:
+        if pager.snapshots is None:
+            execute_result = execute_statement(statement, database.table, connection.writer)
+            pager_maybe_checkpoint(pager)
+            return execute_result
+
+        version_begin(pager)
+        execute_result = execute_statement(statement, database.table, connection.writer)
+        version_commit(pager)
+        # a snapshot taken in between just doesn't get to use a new index
+        database.committed_indexes = dict(database.table.indexes)
+        # snapshot readers may be reading the file and the log meanwhile
+        with pager.cache_latch:
+            with pager.file_latch:
+                pager_maybe_checkpoint(pager)
+        return execute_result
+    finally:
+        commit = pager.wal_commits
+        write_lock_release(database.lock)
+        wal_wait_durable(pager, commit)
+
+
+def read_database(connection, read):
+    # call read(table) the way a select runs, on a snapshot with mvcc and under the read lock otherwise
+    database = connection.database
+    pager = database.table.pager
+    if pager.snapshots is not None:
+        snapshot, table = database_snapshot_begin(database)
+        pager.thread_state.snapshot = snapshot
+        try:
+            return read(table)
+        finally:
+            pager.thread_state.snapshot = None
+            snapshot_end(pager, snapshot)
+
+    read_lock_acquire(database.lock)
+    try:
+        return read(database.table)
+    finally:
+        read_lock_release(database.lock)
+
+
+def stats(connection):
+    # what .stats prints, as a dict
+    return read_database(connection, database_stats)
+
+
+def database_snapshot_begin(database):
+    # a snapshot of the last commit and a table to read it through
+    pager = database.table.pager
+    with pager.cache_latch:
+        snapshot = pager.committed_version
+        pager.snapshots[snapshot] = pager.snapshots.get(snapshot, 0) + 1
+        table = Table(pager, database.table.root_page_num, database.table.layout)
+        table.indexes = database.committed_indexes
+    return snapshot, table
+
+
+def iter_rows(connection, sql):
+    # yield the rows of a select, writers wait until the iteration is done or abandoned
+    statement, result = prepare_statement(InputBuffer(sql))
+    if result != PREPARE_SUCCESS or statement.type != STATEMENT_SELECT or statement.aggregate is not None:
+        raise ValueError("Not a valid select statement: '%s'." % sql)
+
+    database = connection.database
+    pager = database.table.pager
+    if pager.snapshots is not None:
+        # the snapshot is only the thread's while this generator produces a batch,
+        # a thread may interleave several iterations
+        snapshot, table = database_snapshot_begin(database)
+        try:
+            pager.thread_state.snapshot = snapshot
+            try:
+                batches = select_leaf_rows(statement, table)
+            finally:
+                pager.thread_state.snapshot = None
+            while True:
+                pager.thread_state.snapshot = snapshot
+                try:
+                    rows = next(batches, None)
+                finally:
+                    pager.thread_state.snapshot = None
+                if rows is None:
+                    return
+                for row in rows:
+                    yield Row(row.id, row.username.rstrip("\x00"), row.email.rstrip("\x00"))
+        finally:
+            snapshot_end(pager, snapshot)
+
+    read_lock_acquire(database.lock)
+    try:
+        for rows in select_leaf_rows(statement, database.table):
+            for row in rows:
+                yield Row(row.id, row.username.rstrip("\x00"), row.email.rstrip("\x00"))
+    finally:
+        read_lock_release(database.lock)
+
+
+def column_matches(row, statement):
+    value = getattr(row, statement.column).rstrip("\x00")
+    if statement.column_prefix:
+        return value.startswith(statement.column_value)
+    return value == statement.column_value
+
+
+def select_leaf_rows_by_column(statement, table):
+    index = table.indexes.get(statement.column)
+    if index is None:
+        # no index on the column, filter a full scan
+        for rows in cursor_leaf_rows(table_start(table)):
+            yield [row for row in rows if column_matches(row, statement)]
+    else:
+        # rows come out in id order either way
+        ids = index_find_ids(index, statement.column, statement.column_value, statement.column_prefix)
+        rows = []
+        for id in sorted(ids):
+            cursor = table_find(table, id)
+            rows.append(cursor_row(cursor))
+        yield rows
+
+
+def execute_create_index(statement, table):
+    if statement.column in table.indexes:
+        return EXECUTE_INDEX_EXISTS
+    create_index(table, statement.column)
+    wal_commit(table.pager)
+    return EXECUTE_SUCCESS
+
+
+def statement_cursor(statement, table):
+    if statement.key_min is None:
+        return table_start(table)
+    # one descent to the lower bound, then along the leaves
+    return table_seek(table, max(statement.key_min, 0))
+
+
+def select_leaf_rows(statement, table):
+    # the rows a select returns, a batch at a time
+    if statement.column is not None:
+        return select_leaf_rows_by_column(statement, table)
+    return cursor_leaf_rows(statement_cursor(statement, table), statement.key_max)
+
+
+def tree_count(table, statement):
+    # whole leaves count by their number of cells, only the last one's keys are looked at
+    cursor = statement_cursor(statement, table)
+    count = 0
+    for node in cursor_leaves(cursor, statement.key_max):
+        end = leaf_node_num_cells(node)
+        if statement.key_max is not None and end and \
+                leaf_node_key(node, end - 1, table.layout) > statement.key_max:
+            end = bisect.bisect_right(leaf_node_keys(node, table.layout), statement.key_max)
+        count += max(end - cursor.cell_num, 0)
+    return count
+
+
+def tree_min_key(table, statement):
+    # the first key along the path to the lower bound
+    cursor = statement_cursor(statement, table)
+    if cursor.end_of_table:
+        return None
+    key = leaf_node_key(get_page(table.pager, cursor.page_num), cursor.cell_num, table.layout)
+    if statement.key_max is not None and key > statement.key_max:
+        return None
+    return key
+
+
+def tree_max_key(table, statement):
+    # the last key along the path to the upper bound, when the leaf there has nothing at or
+    # below it the answer is the largest key of the subtree just left of the path
+    pager = table.pager
+    layout = table.layout
+    node = get_page(pager, table.root_page_num)
+    if statement.key_max is None:
+        if get_node_type(node) == NODE_LEAF and leaf_node_num_cells(node) == 0:
+            return None
+        key = get_node_max_key(pager, node, layout)
+    else:
+        left_page_num = None
+        while get_node_type(node) == NODE_INTERNAL:
+            child_index = internal_node_find_child(node, statement.key_max, layout)
+            if child_index > 0:
+                left_page_num = internal_node_child(node, child_index - 1, layout)
+            node = get_page(pager, internal_node_child(node, child_index, layout))
+        keys = leaf_node_keys(node, layout)
+        index = bisect.bisect_right(keys, statement.key_max)
+        if index > 0:
+            key = keys[index - 1]
+        elif left_page_num is not None:
+            # internal keys can be stale after deletes, the leaves have the real ones
+            key = get_node_max_key(pager, get_page(pager, left_page_num), layout)
+        else:
+            return None
+    if statement.key_min is not None and key < statement.key_min:
+        return None
+    return key
+
+
+def select_aggregate(statement, table):
+    # only a filter on another column needs the rows themselves
+    if statement.column is not None:
+        ids = [row.id for rows in select_leaf_rows(statement, table) for row in rows]
+        if statement.aggregate == AGGREGATE_COUNT:
+            return len(ids)
+        return combine_aggregates(statement.aggregate, ids)
+    if statement.aggregate == AGGREGATE_COUNT:
+        return tree_count(table, statement)
+    elif statement.aggregate == AGGREGATE_MIN:
+        return tree_min_key(table, statement)
+    return tree_max_key(table, statement)
+
+
+def combine_aggregates(aggregate, values):
+    # the aggregate over all of several parts, from the aggregate of each
+    if aggregate == AGGREGATE_COUNT:
+        return sum(values)
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    if aggregate == AGGREGATE_MIN:
+        return min(values)
+    return max(values)
+
+
+def execute_select(statement, table, writer):
+    if statement.aggregate is not None:
+        writer_write_value(writer, select_aggregate(statement, table))
+        writer_flush(writer)
+        return EXECUTE_SUCCESS
+    for rows in select_leaf_rows(statement, table):
+        writer_write_rows(writer, rows)
+    writer_flush(writer)
+
+    return EXECUTE_SUCCESS
+
+
+def execute_delete(statement, table):
+    # the rows are collected first, deleting rebalances the leaves under the cursor
+    rows = [row for row in cursor_rows(statement_cursor(statement, table), statement.key_max)]
+    for row in rows:
+        tree_delete(table, row.id)
+        for column, index in table.indexes.items():
+            tree_delete(index, index_key(column, row))
+    wal_commit(table.pager)
+    return EXECUTE_SUCCESS
+
+
+def execute_update(statement, table):
+    pager = table.pager
+    layout = table.layout
+    rows = [row for row in cursor_rows(statement_cursor(statement, table), statement.key_max)]
+    for row in rows:
+        new_row = Row(row.id, statement.assignments.get("username", row.username),
+                      statement.assignments.get("email", row.email))
+        for column, index in table.indexes.items():
+            old_key = index_key(column, row)
+            new_key = index_key(column, new_row)
+            if old_key != new_key:
+                tree_delete(index, old_key)
+                tree_insert_entries(index, [(new_key, None)])
+
+        if layout.slotted:
+            # the new row may not be the same size, it goes back in as a new cell
+            tree_delete(table, row.id)
+            tree_insert_entries(table, [(row.id, new_row)])
+            continue
 
+        # the row keeps its id, so it is rewritten where it is
+        cursor = table_find(table, row.id)
+        node = get_page(pager, cursor.page_num)
+        serialize_row(new_row, node, leaf_node_cell_offset(cursor.cell_num, layout) + layout.key_size)
+        mark_page_dirty(pager, cursor.page_num)
+    wal_commit(pager)
     return EXECUTE_SUCCESS
 
 
-def execute_statement(statement, table):
+def execute_statement(statement, table, writer):
+    start = time.time()
+    if table.partitions is not None:
+        result = execute_partitioned(statement, table, writer)
+    else:
+        result = execute_tree_statement(statement, table, writer)
+    record_statement_latency(table.pager, statement.type, time.time() - start)
+    return result
+
+
+def execute_tree_statement(statement, table, writer):
     if statement.type == STATEMENT_INSERT:
         return execute_insert(statement, table)
     elif statement.type == STATEMENT_SELECT:
-        return execute_select(table)
+        return execute_select(statement, table, writer)
+    elif statement.type == STATEMENT_CREATE_INDEX:
+        return execute_create_index(statement, table)
+    elif statement.type == STATEMENT_DELETE:
+        return execute_delete(statement, table)
+    elif statement.type == STATEMENT_UPDATE:
+        return execute_update(statement, table)
+
+
+def execute_partitioned(statement, table, writer):
+    # a statement on one id goes to the partition holding it, anything else to all of them
+    if statement.type == STATEMENT_INSERT:
+        return execute_partitioned_insert(statement, table)
+    if statement.column is None and statement.key_min is not None and statement.key_min == statement.key_max:
+        return execute_tree_statement(statement, table_partition(table, statement.key_min), writer)
+    if statement.type == STATEMENT_SELECT:
+        return execute_partitioned_select(statement, table, writer)
+
+    result = EXECUTE_SUCCESS
+    for partition in table.partitions:
+        partition_result = execute_tree_statement(statement, partition, writer)
+        if partition_result != EXECUTE_SUCCESS:
+            result = partition_result
+    return result
+
+
+def partition_rows(table, rows):
+    # (partition, its rows) for every partition some of the rows go to
+    rows_by_partition = {}
+    for row in rows:
+        rows_by_partition.setdefault(row.id % len(table.partitions), []).append(row)
+    return [(table.partitions[partition_num], rows_by_partition[partition_num])
+            for partition_num in sorted(rows_by_partition)]
+
+
+def execute_partitioned_insert(statement, table):
+    rows = statement.rows_to_insert
+    if rows is None:
+        rows = [statement.row_to_insert]
+    # a repeated key always lands in the same partition, every partition is checked
+    # before any of them is written
+    targets = [(partition, sorted(rows, key=lambda row: row.id))
+               for partition, rows in partition_rows(table, rows)]
+    if any(rows_have_duplicate_key(rows, partition) for partition, rows in targets):
+        return EXECUTE_DUPLICATE_KEY
+    for partition, rows in targets:
+        insert_rows(rows, partition)
+    return EXECUTE_SUCCESS
+
+
+def execute_partitioned_select(statement, table, writer):
+    # every partition returns its rows in id order, merging them keeps that order
+    parallel = partition_fans_out(table, statement)
+    if statement.aggregate is not None:
+        values = partition_map(table, partition_aggregate, (statement,), parallel)
+        writer_write_value(writer, combine_aggregates(statement.aggregate, values))
+        writer_flush(writer)
+        return EXECUTE_SUCCESS
+    rows = []
+    for id, username, email in heapq.merge(*partition_map(table, partition_select_rows, (statement,), parallel)):
+        rows.append(Row(id, username, email))
+        if len(rows) == PARTITION_MERGE_BATCH:
+            writer_write_rows(writer, rows)
+            rows = []
+    writer_write_rows(writer, rows)
+    writer_flush(writer)
+    return EXECUTE_SUCCESS
+
+
+def partition_select_rows(partition, statement):
+    # plain tuples, they are cheaper to send back from a worker than rows
+    return [(row.id, row.username, row.email)
+            for rows in select_leaf_rows(statement, partition) for row in rows]
+
+
+def partition_aggregate(partition, statement):
+    return select_aggregate(statement, partition)
+
+
+# the partitioned table a pool worker was forked from
+partition_worker_table = None
+
+
+def partition_map(table, function, args, parallel):
+    # [function(partition, *args) for each partition], spread over the table's pool of
+    # workers when it has one and the work is worth it
+    if table.partition_pool is None or not parallel:
+        return [function(partition, *args) for partition in table.partitions]
+    tasks = [(partition_num, partition_publish(table.partitions[partition_num]), function, args)
+             for partition_num in range(len(table.partitions))]
+    return table.partition_pool.map(partition_task, tasks)
+
+
+def partition_fans_out(table, statement):
+    # only a scan over the whole table is worth handing to the pool, ranges, min and max
+    # and index lookups are cheaper to answer right here
+    if statement.key_min is not None or statement.key_max is not None:
+        return False
+    if statement.aggregate in (AGGREGATE_MIN, AGGREGATE_MAX):
+        return False
+    return statement.column is None or statement.column not in table.partitions[0].indexes
+
+
+def partition_publish(partition):
+    # write out the pages the workers can't see and tell them where to find everything,
+    # in the log or in a compressed file pages move around
+    pager = partition.pager
+    for page_num in sorted(pager.dirty_pages):
+        pager_flush(pager, page_num)
+    if pager.wal_file is not None:
+        pager.wal_file.flush()
+    pager.file_descriptor.flush()
+    return pager.file_length, pager.num_pages, pager.wal_index, pager.page_locations
+
+
+def partition_worker_start(table):
+    # a worker only reads, through files of its own since the parent's share their positions
+    global partition_worker_table
+    partition_worker_table = table
+    for partition in table.partitions:
+        pager = partition.pager
+        # shared mappings need a descriptor open for writing, nothing is written through them;
+        # unbuffered since a read-only buffer survives seeks and would hide the parent's writes
+        pager.file_descriptor = open(pager.file_descriptor.name, "rb+" if pager.use_mmap else "rb", 0)
+        if pager.wal_file is not None:
+            pager.wal_file = open(pager.wal_file.name, "rb", 0)
+
+
+def partition_task(task):
+    partition_num, state, function, args = task
+    partition = partition_worker_table.partitions[partition_num]
+    pager = partition.pager
+    # whatever the worker cached may have changed since
+    if pager.use_mmap:
+        for page in pager.pages.values():
+            page.close()
+    pager.pages.clear()
+    pager.pin_counts.clear()
+    pager.dirty_pages.clear()
+    pager.file_length, pager.num_pages, pager.wal_index, pager.page_locations = state
+    pager.catalog_page_num = node_parent(get_page(pager, 0))
+    partition.indexes = {}
+    load_indexes(partition)
+    return function(partition, *args)
+
+
+def trace_begin(pager, tracing):
+    # None unless the statement is traced or might end up in the slow log
+    if not tracing and pager.slow_log is None:
+        return None
+    if tracing:
+        pager.traced_pages = set()
+    return StatementTrace(pager)
+
+
+def trace_end(pager, trace, text):
+    # counters under a shared pager include whatever ran alongside the statement
+    if trace is None:
+        return
+    trace.seconds = time.time() - trace.start
+    trace.page_accesses = pager.cache_hits + pager.cache_misses - trace.page_accesses
+    trace.cache_misses = pager.cache_misses - trace.cache_misses
+    trace.pages_read = pager.pages_read - trace.pages_read
+    trace.leaf_splits = pager.leaf_splits - trace.leaf_splits
+    trace.internal_splits = pager.internal_splits - trace.internal_splits
+    trace.root_splits = pager.root_splits - trace.root_splits
+    if pager.traced_pages is not None:
+        trace.pages = sorted(pager.traced_pages)
+        pager.traced_pages = None
+    if pager.slow_log is not None and trace.seconds >= pager.slow_log_threshold:
+        line = "%s %s: %s\n" % (time.strftime("%Y-%m-%dT%H:%M:%S"), text, format_trace(trace))
+        with pager.slow_log_latch:
+            pager.slow_log.write(line)
+            pager.slow_log.flush()
+
+
+def slow_log_open(pager, filename, threshold):
+    # statements taking threshold seconds or more are appended to filename
+    pager.slow_log = open(filename, "a")
+    pager.slow_log_threshold = threshold
+    pager.slow_log_latch = threading.Lock()
+
+
+def format_trace(trace):
+    text = "%.3f ms, %d page accesses, %d cache misses, %d pages read, splits: %d leaf %d internal %d root" % (
+        trace.seconds * 1e3, trace.page_accesses, trace.cache_misses, trace.pages_read,
+        trace.leaf_splits, trace.internal_splits, trace.root_splits)
+    if trace.pages is not None:
+        listed = " ".join(str(page_num) for page_num in trace.pages[:TRACE_MAX_LISTED_PAGES])
+        if len(trace.pages) > TRACE_MAX_LISTED_PAGES:
+            listed += " ..."
+        text += ", %d pages touched: %s" % (len(trace.pages), listed)
+    return text
+
+
+def record_statement_latency(pager, statement_type, seconds):
+    # bucket i counts latencies under 2**i microseconds and at least half that,
+    # counts from concurrent readers may race and come out a little low
+    histogram = pager.statement_latencies.get(statement_type)
+    if histogram is None:
+        histogram = pager.statement_latencies[statement_type] = [0] * LATENCY_HISTOGRAM_BUCKETS
+    histogram[min(int(seconds * 1e6).bit_length(), LATENCY_HISTOGRAM_BUCKETS - 1)] += 1
+
+
+def tree_shape(table):
+    # height of the tree, its number of leaves and how full they are on average
+    pager = table.pager
+    layout = table.layout
+    page_num = table.root_page_num
+    height = 1
+    node = get_page(pager, page_num)
+    while get_node_type(node) == NODE_INTERNAL:
+        page_num = internal_node_child(node, 0, layout)
+        node = get_page(pager, page_num)
+        height += 1
+
+    num_leaves = 0
+    fill = 0.0
+    while True:
+        num_leaves += 1
+        if layout.slotted:
+            fill += 1 - float(slotted_leaf_node_free_bytes(node, layout)) / SLOTTED_LEAF_NODE_SPACE_FOR_CELLS
+        else:
+            fill += float(leaf_node_num_cells(node)) / layout.leaf_node_max_cells
+        page_num = leaf_node_next_leaf(node)
+        if page_num == 0:
+            break
+        node = get_page(pager, page_num)
+    return height, num_leaves, fill / num_leaves
+
+
+def database_stats(table):
+    # counters since the database was opened and the shape of the table's tree
+    pager = table.pager
+    height, num_leaves, leaf_fill_factor = tree_shape(table)
+    return {
+        "pages": pager.num_pages,
+        "file_size": pager.file_length,
+        "cache_hits": pager.cache_hits,
+        "cache_misses": pager.cache_misses,
+        "pages_read": pager.pages_read,
+        "pages_read_ahead": pager.pages_read_ahead,
+        "pages_written": pager.pages_written,
+        "leaf_splits": pager.leaf_splits,
+        "internal_splits": pager.internal_splits,
+        "root_splits": pager.root_splits,
+        "tree_height": height,
+        "leaves": num_leaves,
+        "leaf_fill_factor": leaf_fill_factor,
+        "statement_latencies": named_statement_latencies(pager),
+    }
+
+
+def named_statement_latencies(pager):
+    statement_latencies = {}
+    for statement_type, histogram in pager.statement_latencies.items():
+        statement_latencies[STATEMENT_TYPE_NAMES[statement_type]] = list(histogram)
+    return statement_latencies
+
+
+def print_stats(stats):
+    print "Pages: %d, file size: %d bytes." % (stats["pages"], stats["file_size"])
+    print "Cache: %d hits, %d misses." % (stats["cache_hits"], stats["cache_misses"])
+    print "Disk: %d pages read (%d ahead), %d pages written." % (stats["pages_read"], stats["pages_read_ahead"],
+                                                                 stats["pages_written"])
+    print "Splits: %d leaf, %d internal, %d root." % (stats["leaf_splits"], stats["internal_splits"],
+                                                      stats["root_splits"])
+    print "Tree: height %d, %d leaves, leaf fill factor %.2f." % (stats["tree_height"], stats["leaves"],
+                                                                  stats["leaf_fill_factor"])
+    print_statement_latencies(stats["statement_latencies"])
+
+
+def print_statement_latencies(statement_latencies):
+    for name in sorted(statement_latencies):
+        histogram = statement_latencies[name]
+        print "Latency of %d %s statements:" % (sum(histogram), name)
+        for bucket in range(LATENCY_HISTOGRAM_BUCKETS):
+            if histogram[bucket] == 0:
+                continue
+            if bucket == LATENCY_HISTOGRAM_BUCKETS - 1:
+                print "  >= %d us: %d" % (2 ** (bucket - 1), histogram[bucket])
+            else:
+                print "  < %d us: %d" % (2 ** bucket, histogram[bucket])
+
+
+def prepare_result_message(result, text):
+    if result == PREPARE_NEGATIVE_ID:
+        return "ID must be positive."
+    elif result == PREPARE_STRING_TOO_LONG:
+        return "String is too long."
+    elif result == PREPARE_SYNTAX_ERROR:
+        return "Syntax error. Could not parse statement."
+    elif result == PREPARE_UNRECOGNIZED_SUCCESS:
+        return "Unrecognized keyword at start of '%s'." % text
+
+
+def execute_result_message(result):
+    if result == EXECUTE_SUCCESS:
+        return "Executed."
+    elif result == EXECUTE_DUPLICATE_KEY:
+        return "Error: Duplicate key."
+    elif result == EXECUTE_TABLE_FULL:
+        return "Error: Table full."
+    elif result == EXECUTE_INDEX_EXISTS:
+        return "Error: Index already exists."
+
+
+class DatabaseServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    # clients still connected don't hold up a shutdown
+    daemon_threads = True
+
+
+class ClientRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        serve_client(Connection(self.server.database), self.request)
+
+
+def serve_client(connection, client_socket):
+    # one statement per line and no prompt, a client may pipeline as many as it likes,
+    # the complete lines of one read run in order and their output goes back together
+    output = client_socket.makefile("wb", OUTPUT_BUFFER_SIZE)
+    connection.writer.stream = output
+    pending = ""
+    while True:
+        data = client_socket.recv(NETWORK_BUFFER_SIZE)
+        if not data:
+            return
+        lines = (pending + data).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r")
+            if line == ".exit":
+                output.flush()
+                return
+            elif not line:
+                continue
+            elif line[0] == ".":
+                output.write("Meta commands are not available over the network.\n")
+                continue
+            prepare_result, execute_result = execute(connection, line)
+            if prepare_result != PREPARE_SUCCESS:
+                output.write(prepare_result_message(prepare_result, line) + "\n")
+            else:
+                output.write(execute_result_message(execute_result) + "\n")
+        output.flush()
+
+
+def stop_serving(signum, frame):
+    # a terminated server shuts down like an interrupted one, flushing the table first
+    raise KeyboardInterrupt
+
+
+def serve(table, address, mvcc=False):
+    # serve clients over tcp until interrupted, all of them share the one table and its cache
+    host, port = address.rsplit(":", 1)
+    with open_databases_lock:
+        database = share_database(os.path.realpath(table.pager.file_descriptor.name), table, mvcc)
+    server = DatabaseServer((host, int(port)), ClientRequestHandler)
+    server.database = database
+    signal.signal(signal.SIGTERM, stop_serving)
+    print "Listening on %s:%d." % server.server_address
+    stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    write_lock_acquire(database.lock)
+    db_close(table)
+
+
+def run_batch(table, lines, writer):
+    # run a script without prompts, only failures are reported, by line, and the whole run
+    # is committed once at the end, returns the number of failed lines
+    statement_counts = {}
+    num_errors = 0
+    start = time.time()
+    for pager in table_pagers(table):
+        pager.batch = True
+    for line_num, line in enumerate(lines, 1):
+        input_buffer = InputBuffer(line.rstrip("\r\n"))
+        if not input_buffer.buffer:
+            continue
+        elif input_buffer.buffer == ".exit":
+            break
+        elif input_buffer.buffer[0] == ".":
+            if do_meta_command(input_buffer, table, writer) == META_COMMAND_UNRECOGNIZED_COMMAND:
+                print "Line %d: Unrecognized command '%s'." % (line_num, input_buffer.buffer)
+                num_errors += 1
+            # .vacuum reopens the pager
+            table.pager.batch = True
+            continue
+
+        statement, result = prepare_statement(input_buffer)
+        if result != PREPARE_SUCCESS:
+            print "Line %d: %s" % (line_num, prepare_result_message(result, input_buffer.buffer))
+            num_errors += 1
+            continue
+        trace = trace_begin(table.pager, table.pager.tracing)
+        result = execute_statement(statement, table, writer)
+        trace_end(table.pager, trace, input_buffer.buffer)
+        if result != EXECUTE_SUCCESS:
+            print "Line %d: %s" % (line_num, execute_result_message(result))
+            num_errors += 1
+        if table.pager.tracing:
+            print "Line %d trace: %s." % (line_num, format_trace(trace))
+        name = STATEMENT_TYPE_NAMES[statement.type]
+        statement_counts[name] = statement_counts.get(name, 0) + 1
+
+    for pager in table_pagers(table):
+        pager.batch = False
+        pager_checkpoint(pager)
+    seconds = time.time() - start
+    num_statements = sum(statement_counts.values())
+    print "Batch complete: %d statements, %d errors in %.3f seconds (%.0f statements per second)." % (
+        num_statements, num_errors, seconds, num_statements / max(seconds, 1e-6))
+    for name in sorted(statement_counts):
+        print "  %s: %d" % (name, statement_counts[name])
+    return num_errors
+
+
+def option_value(argv, name, default):
+    # value following a command line flag, options come after the filename
+    if name in argv[2:]:
+        return argv[argv.index(name) + 1]
+    return default
 
 
 def main(argv):
@@ -808,13 +3738,55 @@ def main(argv):
         print "Must supply a database filename."
         exit(0)
     filename = argv[1]
-    table = db_open(filename)
+    use_mmap = "--mmap" in argv[2:]
+    max_cached_pages = int(option_value(argv, "--cache-pages", DEFAULT_CACHE_PAGES))
+    # only meant for tests, a small fan-out makes internal splits easy to reach
+    internal_node_max_cells = int(option_value(argv, "--internal-node-max-cells", INTERNAL_NODE_MAX_CELLS))
+    for layout in TREE_LAYOUTS:
+        layout.internal_node_max_cells = min(layout.internal_node_max_cells, internal_node_max_cells)
+    use_wal = "--wal" in argv[2:]
+    leaf_format = LEAF_FORMAT_FIXED
+    if "--slotted" in argv[2:]:
+        leaf_format = LEAF_FORMAT_SLOTTED
+    compress = "--compress" in argv[2:]
+    num_partitions = int(option_value(argv, "--partitions", 1))
+    partition_workers = option_value(argv, "--partition-workers", None)
+    if partition_workers is not None:
+        partition_workers = int(partition_workers)
+    table = db_open(filename, use_mmap, max_cached_pages, use_wal, leaf_format, compress, num_partitions,
+                    partition_workers)
+    for pager in table_pagers(table):
+        pager.wal_commit_window = float(option_value(argv, "--wal-commit-window",
+                                                     DEFAULT_WAL_COMMIT_WINDOW))
+        pager.checkpoint_dirty_pages = int(option_value(argv, "--checkpoint-pages",
+                                                        DEFAULT_CHECKPOINT_DIRTY_PAGES))
+        pager.checkpoint_interval = float(option_value(argv, "--checkpoint-interval",
+                                                       DEFAULT_CHECKPOINT_INTERVAL))
+        pager.readahead_pages = min(pager.readahead_pages,
+                                    int(option_value(argv, "--readahead-pages", DEFAULT_READAHEAD_PAGES)))
+    if "--slow-log" in argv[2:]:
+        slow_log_open(table.pager, option_value(argv, "--slow-log", None),
+                      float(option_value(argv, "--slow-log-threshold", DEFAULT_SLOW_LOG_THRESHOLD)))
+    if "--serve" in argv[2:]:
+        serve(table, option_value(argv, "--serve", None), "--mvcc" in argv[2:])
+        return
+    writer = ResultWriter(stdout, OUTPUT_FORMAT_TEXT)
+    if "--script" in argv[2:] or "--batch" in argv[2:]:
+        if "--script" in argv[2:]:
+            lines = open(option_value(argv, "--script", None), "r", BATCH_READ_BUFFER_SIZE)
+        else:
+            lines = os.fdopen(stdin.fileno(), "r", BATCH_READ_BUFFER_SIZE)
+        num_errors = run_batch(table, lines, writer)
+        db_close(table)
+        exit(1 if num_errors else 0)
     while True:
         print_prompt()
         input_buffer = read_input()
 
-        if input_buffer.buffer[0] == ".":
-            result = do_meta_command(input_buffer, table)
+        if not input_buffer.buffer:
+            continue
+        elif input_buffer.buffer[0] == ".":
+            result = do_meta_command(input_buffer, table, writer)
             if result == META_COMMAND_SUCCESS:
                 continue
             elif result == META_COMMAND_UNRECOGNIZED_COMMAND:
@@ -822,28 +3794,18 @@ def main(argv):
                 continue
 
         statement, result = prepare_statement(input_buffer)
-        if result == PREPARE_SUCCESS:
-            pass
-        elif result == PREPARE_NEGATIVE_ID:
-            print "ID must be positive."
-            continue
-        elif result == PREPARE_STRING_TOO_LONG:
-            print "String is too long."
-            continue
-        elif result == PREPARE_SYNTAX_ERROR:
-            print "Syntax error. Could not parse statement."
-            continue
-        elif result == PREPARE_UNRECOGNIZED_SUCCESS:
-            print "Unrecognized keyword at start of '%s'." % input_buffer.buffer
+        if result != PREPARE_SUCCESS:
+            print prepare_result_message(result, input_buffer.buffer)
             continue
 
-        result = execute_statement(statement, table)
-        if result == EXECUTE_SUCCESS:
-            print "Executed."
-        elif result == EXECUTE_DUPLICATE_KEY:
-            print "Error: Duplicate key."
-        elif result == EXECUTE_TABLE_FULL:
-            print "Error: Table full."
+        trace = trace_begin(table.pager, table.pager.tracing)
+        result = execute_statement(statement, table, writer)
+        trace_end(table.pager, trace, input_buffer.buffer)
+        print execute_result_message(result)
+        if table.pager.tracing:
+            print "Trace: %s." % format_trace(trace)
+        for pager in table_pagers(table):
+            pager_maybe_checkpoint(pager)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
+require 'json'
+require 'socket'
+
 describe 'database' do
-  def run_script(commands)
+  def run_script(commands, options = "")
     raw_output = nil
-    IO.popen("python main.py mydb.db", "r+") do |pipe|
+    IO.popen("python main.py mydb.db #{options}", "r+") do |pipe|
       commands.each do |command|
         begin
           pipe.puts command
@@ -31,16 +34,30 @@ describe 'database' do
     ])
   end
 
-  it 'prints error message when table is full' do
+  it 'prompts again after an empty line' do
+    IO.popen("> mydb.db")
+    result = run_script([
+      "",
+      "insert 1 user1 person1@example.com",
+      "",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > db > Executed.",
+      "db > db > ",
+    ])
+  end
+
+  it 'keeps inserting once internal nodes need to split' do
     IO.popen("> mydb.db")
     script = (1..1401).map do |i|
       "insert #{i} user#{i} person#{i}@example.com"
     end
     script << ".exit"
-    result = run_script(script)
+    result = run_script(script, "--internal-node-max-cells 3")
     expect(result.last(2)).to match_array([
       "db > Executed.",
-      "db > Need to implement splitting internal node",
+      "db > ",
     ])
   end
 
@@ -323,4 +340,703 @@ describe 'database' do
       "db > ",
     ])
   end
+
+  it 'keeps data after closing connection in mmap mode' do
+    IO.popen("> mydb.db")
+    script = (1..15).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".exit"
+    run_script(script, "--mmap")
+    result = run_script([
+      "select",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > (1, user1, person1@example.com)",
+      "(2, user2, person2@example.com)",
+      "(3, user3, person3@example.com)",
+      "(4, user4, person4@example.com)",
+      "(5, user5, person5@example.com)",
+      "(6, user6, person6@example.com)",
+      "(7, user7, person7@example.com)",
+      "(8, user8, person8@example.com)",
+      "(9, user9, person9@example.com)",
+      "(10, user10, person10@example.com)",
+      "(11, user11, person11@example.com)",
+      "(12, user12, person12@example.com)",
+      "(13, user13, person13@example.com)",
+      "(14, user14, person14@example.com)",
+      "(15, user15, person15@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'keeps every row when the page cache is smaller than the tree' do
+    IO.popen("> mydb.db")
+    script = [18, 7, 10, 29, 23, 4, 14, 30, 15, 26, 22, 19, 2, 1, 21,
+              11, 6, 20, 5, 8, 9, 3, 12, 27, 17, 16, 13, 24, 25, 28].map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << "insert 5 user5 person5@example.com"
+    script << "select"
+    script << ".exit"
+    result = run_script(script, "--cache-pages 2")
+
+    expected = (1..30).map { |i| "(#{i}, user#{i}, person#{i}@example.com)" }
+    expected[0] = "db > " + expected[0]
+    expect(result[30...(result.length)]).to match_array([
+      "db > Error: Duplicate key.",
+    ] + expected + [
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'allows printing out the structure of a btree with internal node splits' do
+    IO.popen("> mydb.db")
+    script = (1..36).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".btree"
+    script << ".exit"
+    result = run_script(script, "--internal-node-max-cells 3")
+
+    expect(result[36...(result.length)]).to match_array([
+      "db > Tree:",
+      "- internal (size 1)",
+      "  - internal (size 2)",
+      "    - leaf (size 7)",
+      "      - 1",
+      "      - 2",
+      "      - 3",
+      "      - 4",
+      "      - 5",
+      "      - 6",
+      "      - 7",
+      "  - key 7",
+      "    - leaf (size 7)",
+      "      - 8",
+      "      - 9",
+      "      - 10",
+      "      - 11",
+      "      - 12",
+      "      - 13",
+      "      - 14",
+      "  - key 14",
+      "    - leaf (size 7)",
+      "      - 15",
+      "      - 16",
+      "      - 17",
+      "      - 18",
+      "      - 19",
+      "      - 20",
+      "      - 21",
+      "- key 21",
+      "  - internal (size 1)",
+      "    - leaf (size 7)",
+      "      - 22",
+      "      - 23",
+      "      - 24",
+      "      - 25",
+      "      - 26",
+      "      - 27",
+      "      - 28",
+      "  - key 28",
+      "    - leaf (size 8)",
+      "      - 29",
+      "      - 30",
+      "      - 31",
+      "      - 32",
+      "      - 33",
+      "      - 34",
+      "      - 35",
+      "      - 36",
+      "db > ",
+    ])
+  end
+
+  it 'writes only dirty pages on checkpoint and keeps them without exiting' do
+    IO.popen("> mydb.db")
+    script = (1..14).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".checkpoint"
+    script << ".checkpoint"
+    result = run_script(script)
+    expect(result[14...16]).to match_array([
+      "db > Checkpoint complete, pages written: 3.",
+      "db > Checkpoint complete, pages written: 0.",
+    ])
+
+    result = run_script([
+      "select",
+      ".exit",
+    ])
+    expect(result.length).to eq(16)
+  end
+
+  it 'recovers committed rows from the write-ahead log after a crash' do
+    IO.popen("> mydb.db")
+    IO.popen("rm -f mydb.db-wal")
+    script = (1..15).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    # no .exit, the process dies at end of input without flushing any page
+    run_script(script, "--wal")
+
+    result = run_script([
+      "select",
+      ".exit",
+    ], "--wal")
+    expect(result.length).to eq(17)
+    expect(result[0]).to eq("db > (1, user1, person1@example.com)")
+    expect(result[14]).to eq("(15, user15, person15@example.com)")
+  end
+
+  it 'syncs a group commit before acknowledging it' do
+    IO.popen("> mydb.db")
+    IO.popen("rm -f mydb.db-wal")
+    program = <<-PYTHON
+import os
+import signal
+import threading
+import main
+
+connection = main.connect("mydb.db", use_wal=True)
+pager = connection.database.table.pager
+pager.wal_commit_window = 0.2
+def insert_rows(first):
+    writer = main.connect("mydb.db", use_wal=True)
+    for i in range(first, first + 5):
+        main.execute(writer, "insert %d user%d person%d@example.com" % (i, i, i))
+threads = [threading.Thread(target=insert_rows, args=(first,)) for first in (1, 6, 11)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print pager.wal_commits, pager.wal_synced_commits
+os.kill(os.getpid(), signal.SIGKILL)
+    PYTHON
+    output = IO.popen(["python", "-c", program]).read
+    # every acknowledged commit was synced, with no later write to sync it
+    expect(output.split("\n")).to match_array(["15 15"])
+
+    result = run_script([
+      "select",
+      ".exit",
+    ], "--wal")
+    expect(result.length).to eq(17)
+    expect(result[14]).to eq("(15, user15, person15@example.com)")
+  end
+
+  it 'bulk loads a sorted import into densely packed leaves' do
+    IO.popen("> mydb.db")
+    File.write("import.csv", (1..20).to_a.reverse.map { |i| "#{i},user#{i},person#{i}@example.com\n" }.join)
+    result = run_script([
+      ".import import.csv",
+      ".btree",
+      ".exit",
+    ])
+    File.delete("import.csv")
+
+    expect(result).to match_array([
+      "db > Imported 20 rows.",
+      "db > Tree:",
+      "- internal (size 1)",
+      "  - leaf (size 13)",
+    ] + (1..13).map { |i| "    - #{i}" } + [
+      "- key 13",
+      "  - leaf (size 7)",
+    ] + (14..20).map { |i| "    - #{i}" } + [
+      "db > ",
+    ])
+  end
+
+  it 'rejects an import fill factor outside (0, 1]' do
+    IO.popen("> mydb.db")
+    File.write("import.csv", "1,user1,person1@example.com\n")
+    result = run_script([
+      ".import import.csv 2.0",
+      ".import import.csv 0",
+      ".import import.csv abc",
+      ".import import.csv 0.5",
+      ".exit",
+    ])
+    File.delete("import.csv")
+
+    expect(result).to match_array([
+      "db > Fill factor must be greater than 0 and at most 1.",
+      "db > Fill factor must be greater than 0 and at most 1.",
+      "db > Fill factor must be greater than 0 and at most 1.",
+      "db > Imported 1 rows.",
+      "db > ",
+    ])
+  end
+
+  it 'selects single rows and id ranges' do
+    IO.popen("> mydb.db")
+    script = (1..30).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << "select where id = 8"
+    script << "select where id = 31"
+    script << "select where id between 13 and 16"
+    script << "select where id > 28"
+    script << "select where id <= 2"
+    script << "select where id is 2"
+    script << ".exit"
+    result = run_script(script)
+
+    expect(result[30...(result.length)]).to match_array([
+      "db > (8, user8, person8@example.com)",
+      "Executed.",
+      "db > Executed.",
+      "db > (13, user13, person13@example.com)",
+      "(14, user14, person14@example.com)",
+      "(15, user15, person15@example.com)",
+      "(16, user16, person16@example.com)",
+      "Executed.",
+      "db > (29, user29, person29@example.com)",
+      "(30, user30, person30@example.com)",
+      "Executed.",
+      "db > (1, user1, person1@example.com)",
+      "(2, user2, person2@example.com)",
+      "Executed.",
+      "db > Syntax error. Could not parse statement.",
+      "db > ",
+    ])
+  end
+
+  it 'writes rows as tab separated values in tsv mode' do
+    IO.popen("> mydb.db")
+    result = run_script([
+      "insert 2 user2 person2@example.com",
+      "insert 1 user1 person1@example.com",
+      ".mode tsv",
+      "select",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > Executed.",
+      "db > Executed.",
+      "db > db > 1\tuser1\tperson1@example.com",
+      "2\tuser2\tperson2@example.com",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'inserts several rows in one statement' do
+    IO.popen("> mydb.db")
+    result = run_script([
+      "insert values (3,user3,person3@example.com),(1,user1,person1@example.com),(2,user2,person2@example.com)",
+      "insert values (4,user4,person4@example.com),(2,user2,person2@example.com)",
+      "insert values (5,user5,person5@example.com),(5,user6,person6@example.com)",
+      "select",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > Executed.",
+      "db > Error: Duplicate key.",
+      "db > Error: Duplicate key.",
+      "db > (1, user1, person1@example.com)",
+      "(2, user2, person2@example.com)",
+      "(3, user3, person3@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'inserts none of a batch when one key is already in the table' do
+    ["", "--partitions 3"].each do |options|
+      IO.popen("> mydb.db")
+      IO.popen("rm -f mydb.db.part*")
+      File.write("import.csv", "3,user3,person3@example.com\n5,user5,person5@example.com\n")
+      result = run_script([
+        "insert 5 user5 person5@example.com",
+        "insert values (8,user8,person8@example.com),(5,user5,person5@example.com),(1,user1,person1@example.com)",
+        ".import import.csv",
+        "select",
+        ".exit",
+      ], options)
+      File.delete("import.csv")
+
+      expect(result).to match_array([
+        "db > Executed.",
+        "db > Error: Duplicate key.",
+        "db > Error: Duplicate key.",
+        "db > (5, user5, person5@example.com)",
+        "Executed.",
+        "db > ",
+      ])
+    end
+    IO.popen("rm -f mydb.db.part*")
+  end
+
+  it 'finds rows by username through an index' do
+    IO.popen("> mydb.db")
+    result = run_script([
+      "insert 3 alice alice@example.com",
+      "create index on username",
+      "insert 1 bob bob@example.com",
+      "insert 2 alicia alicia@example.com",
+      "select where username = 'alice'",
+      "select where username like 'ali%'",
+      "create index on username",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > Executed.",
+      "db > Executed.",
+      "db > Executed.",
+      "db > Executed.",
+      "db > (3, alice, alice@example.com)",
+      "Executed.",
+      "db > (2, alicia, alicia@example.com)",
+      "(3, alice, alice@example.com)",
+      "Executed.",
+      "db > Error: Index already exists.",
+      "db > ",
+    ])
+  end
+
+  it 'deletes and updates rows and vacuums the freed pages' do
+    IO.popen("> mydb.db")
+    script = (1..30).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << "delete where id between 2 and 29"
+    script << "update set email = new@example.com where id = 30"
+    script << ".vacuum"
+    script << "select"
+    script << ".exit"
+    result = run_script(script)
+    expect(result[30..-1]).to match_array([
+      "db > Executed.",
+      "db > Executed.",
+      "db > Vacuum complete, pages freed: 5.",
+      "db > (1, user1, person1@example.com)",
+      "(30, user30, new@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'fits more rows in a leaf with the slotted format' do
+    IO.popen("> mydb.db")
+    script = (1..20).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".btree"
+    script << "select where id = 20"
+    script << ".exit"
+    result = run_script(script, "--slotted")
+    expect(result[20...24]).to match_array([
+      "db > Tree:",
+      "- leaf (size 20)",
+      "  - 1",
+      "  - 2",
+    ])
+    expect(result[-3..-1]).to match_array([
+      "db > (20, user20, person20@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'keeps a compressed database compressed after reopening' do
+    IO.popen("> mydb.db")
+    script = (1..30).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".exit"
+    run_script(script, "--compress")
+    result = run_script([
+      "select where id = 30",
+      ".compression",
+      ".exit",
+    ])
+    expect(result[0..1]).to match_array([
+      "db > (30, user30, person30@example.com)",
+      "Executed.",
+    ])
+    expect(result[2]).to match(/^db > Pages stored: 5, bytes stored: \d+, compression ratio: \d+\.\d+/)
+    expect(File.size("mydb.db")).to be < 4 * 4096
+  end
+
+  it 'serves concurrent selects through the library api' do
+    IO.popen("> mydb.db")
+    program = <<-PYTHON
+import threading
+import main
+
+connection = main.connect("mydb.db")
+for i in range(1, 51):
+    main.execute(connection, "insert %d user%d person%d@example.com" % (i, i, i))
+counts = []
+def count_rows():
+    reader = main.connect("mydb.db")
+    counts.append(len(list(main.iter_rows(reader, "select where id > 10"))))
+    main.close(reader)
+threads = [threading.Thread(target=count_rows) for _ in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+print counts
+main.close(connection)
+    PYTHON
+    output = IO.popen(["python", "-c", program]).read
+    expect(output.split("\n")).to match_array(["[40, 40, 40, 40]"])
+    result = run_script([
+      "select where id = 50",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > (50, user50, person50@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'answers pipelined statements over the network' do
+    IO.popen("> mydb.db")
+    server = IO.popen("python main.py mydb.db --serve 127.0.0.1:0", "r")
+    port = server.gets[/:(\d+)\./, 1].to_i
+    socket = TCPSocket.new("127.0.0.1", port)
+    socket.write([
+      "insert 1 user1 person1@example.com",
+      "insert 1 user1 person1@example.com",
+      "select",
+      ".exit",
+    ].join("\n") + "\n")
+    result = socket.read.split("\n")
+    socket.close
+    Process.kill("TERM", server.pid)
+    server.close
+    expect(result).to match_array([
+      "Executed.",
+      "Error: Duplicate key.",
+      "(1, user1, person1@example.com)",
+      "Executed.",
+    ])
+    result = run_script([
+      "select",
+      ".exit",
+    ])
+    expect(result).to match_array([
+      "db > (1, user1, person1@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'lets writers go on while a snapshot read is open' do
+    IO.popen("> mydb.db")
+    program = <<-PYTHON
+import main
+
+connection = main.connect("mydb.db", mvcc=True)
+for i in range(1, 31):
+    main.execute(connection, "insert %d user%d person%d@example.com" % (i, i, i))
+rows = main.iter_rows(connection, "select")
+first_row = next(rows)
+print main.execute(connection, "delete where id between 2 and 30")
+print main.execute(connection, "insert 31 user31 person31@example.com")
+print first_row.id, len(list(rows))
+print [row.id for row in main.iter_rows(connection, "select")]
+main.close(connection)
+    PYTHON
+    output = IO.popen(["python", "-c", program]).read
+    expect(output.split("\n")).to match_array([
+      "(0, 0)",
+      "(0, 0)",
+      "1 29",
+      "[1, 31]",
+    ])
+  end
+
+  it 'writes benchmark results as json' do
+    system("python bench.py --sizes 4000 --output bench-results.json > /dev/null")
+    report = JSON.parse(File.read("bench-results.json"))
+    File.delete("bench-results.json")
+    expect(report["results"].map { |result| result["workload"] }).to match_array([
+      "insert_sequential",
+      "insert_random",
+      "insert_reverse",
+      "lookup_point",
+      "scan_range",
+      "scan_full",
+    ])
+    expect(report["results"].map { |result| result["rows"] }.uniq).to match_array([4000])
+    expect(report["results"][0]["latency_us"].keys).to match_array(["p50", "p95", "p99", "max"])
+  end
+
+  it 'prints cache, split and tree stats' do
+    IO.popen("> mydb.db")
+    script = (1..14).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".stats"
+    script << ".exit"
+    result = run_script(script)
+    expect(result).to include(
+      "Splits: 1 leaf, 0 internal, 1 root.",
+      "Tree: height 2, 2 leaves, leaf fill factor 0.54.",
+      "Latency of 14 insert statements:",
+    )
+  end
+
+  it 'prints statement latencies once for a partitioned table and keeps them across a vacuum' do
+    IO.popen("> mydb.db")
+    Dir.glob("mydb.db.part*").each { |filename| File.delete(filename) }
+    result = run_script([
+      "insert 1 user1 person1@example.com",
+      "insert 2 user2 person2@example.com",
+      ".stats",
+      ".exit",
+    ], "--partitions 2")
+    Dir.glob("mydb.db.part*").each { |filename| File.delete(filename) }
+    latencies = result.index("All partitions:")
+    expect(latencies).to be > result.index("Partition 1:")
+    expect(result[latencies + 1]).to eq("Latency of 2 insert statements:")
+    expect(result.count { |line| line.start_with?("Latency of") }).to eq(1)
+
+    IO.popen("> mydb.db")
+    result = run_script([
+      "insert 1 user1 person1@example.com",
+      ".vacuum",
+      "insert 2 user2 person2@example.com",
+      ".stats",
+      ".exit",
+    ])
+    expect(result).to include("Latency of 2 insert statements:")
+  end
+
+  it 'traces statements and logs the slow ones' do
+    IO.popen("> mydb.db")
+    File.delete("slow.log") if File.exist?("slow.log")
+    script = (1..13).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".trace on"
+    script << "insert 14 user14 person14@example.com"
+    script << ".exit"
+    result = run_script(script, "--slow-log slow.log --slow-log-threshold 0")
+    expect(result[-2]).to match(/^Trace: [0-9.]+ ms, .*splits: 1 leaf 0 internal 1 root, 3 pages touched: 0 1 2\.$/)
+    slow_log = File.readlines("slow.log")
+    File.delete("slow.log")
+    expect(slow_log.length).to eq(14)
+    expect(slow_log[-1]).to match(/ insert 14 user14 person14@example.com: [0-9.]+ ms, /)
+  end
+
+  it 'keeps tracing and logging slow statements after a vacuum' do
+    IO.popen("> mydb.db")
+    File.delete("slow.log") if File.exist?("slow.log")
+    result = run_script([
+      ".trace on",
+      "insert 1 user1 person1@example.com",
+      ".vacuum",
+      "insert 2 user2 person2@example.com",
+      ".exit",
+    ], "--slow-log slow.log --slow-log-threshold 0")
+    expect(result[-2]).to match(/^Trace: [0-9.]+ ms, /)
+    slow_log = File.readlines("slow.log")
+    File.delete("slow.log")
+    expect(slow_log.length).to eq(2)
+    expect(slow_log[-1]).to match(/ insert 2 user2 person2@example.com: [0-9.]+ ms, /)
+  end
+
+  it 'reads the leaves of a scan ahead' do
+    IO.popen("> mydb.db")
+    script = (1..600).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".exit"
+    run_script(script)
+    result = run_script([".trace on", "select", ".exit"], "--cache-pages 20")
+    expect(result.count { |line| line =~ /^(db > )*\(\d+, / }).to eq(600)
+    # one miss for the root and one for the first leaf, the other leaves were read ahead
+    expect(result.find { |line| line.start_with?("Trace:") }).to match(/, 2 cache misses, 85 pages read,/)
+  end
+
+  it 'runs a script in batch mode' do
+    IO.popen("> mydb.db")
+    script = (1..50).map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << "insert 1 user1 person1@example.com"
+    script << ""
+    script << "select where id between 49 and 60"
+    File.write("script.sql", script.join("\n") + "\n")
+    result = `python main.py mydb.db --script script.sql`.split("\n")
+    status = $?.exitstatus
+    File.delete("script.sql")
+    expect(status).to eq(1)
+    expect(result[0..2]).to match_array([
+      "Line 51: Error: Duplicate key.",
+      "(49, user49, person49@example.com)",
+      "(50, user50, person50@example.com)",
+    ])
+    expect(result[3]).to match(/^Batch complete: 52 statements, 1 errors in [0-9.]+ seconds/)
+    expect(result[4..5]).to match_array([
+      "  insert: 51",
+      "  select: 1",
+    ])
+  end
+
+  it 'spreads a partitioned table over several files' do
+    IO.popen("> mydb.db")
+    Dir.glob("mydb.db.part*").each { |filename| File.delete(filename) }
+    script = [9, 2, 7, 4, 1, 8, 3, 6, 5].map do |i|
+      "insert #{i} user#{i} person#{i}@example.com"
+    end
+    script << ".exit"
+    run_script(script, "--partitions 3")
+    expect(Dir.glob("mydb.db.part*").sort).to eq(["mydb.db.part1", "mydb.db.part2"])
+
+    result = run_script([
+      "select where id between 3 and 6",
+      "select where id = 8",
+      ".exit",
+    ], "--partition-workers 2")
+    Dir.glob("mydb.db.part*").each { |filename| File.delete(filename) }
+    # merged back into id order
+    expect(result).to eq([
+      "db > (3, user3, person3@example.com)",
+      "(4, user4, person4@example.com)",
+      "(5, user5, person5@example.com)",
+      "(6, user6, person6@example.com)",
+      "Executed.",
+      "db > (8, user8, person8@example.com)",
+      "Executed.",
+      "db > ",
+    ])
+  end
+
+  it 'answers count, min and max from the tree' do
+    IO.popen("> mydb.db")
+    script = (1..100).map do |i|
+      "insert #{i * 2} user#{i} person#{i}@example.com"
+    end
+    script << "delete where id between 41 and 60"
+    script << "select count(*)"
+    script << "select count(*) where id between 10 and 99"
+    script << "select min(id) where id > 40"
+    script << "select max(id) where id < 61"
+    script << "select max(id)"
+    script << "select min(id) where id > 500"
+    script << ".exit"
+    result = run_script(script)
+    expect(result.select { |line| line.include?("(") }).to eq([
+      "db > (90)",
+      "db > (35)",
+      "db > (62)",
+      "db > (40)",
+      "db > (200)",
+      "db > (NULL)",
+    ])
+  end
 end